@@ -1,8 +1,15 @@
-import sys as _sys, os as _os, threading as _threading, re as _re, binascii as _binascii, urllib.request as _request, logging as _logging, platform as _platform, ssl as _ssl
+import sys as _sys, os as _os, threading as _threading, re as _re, collections as _collections, binascii as _binascii, urllib.request as _request, logging as _logging, platform as _platform, ssl as _ssl
 import permissions as _permissions, extension_manager as _extension_manager, config as _config, time as _time, sandbox.util as _util
+import static_files as _static_files, responses as _responses, metrics as _metrics, rpc_framing as _rpc_framing
 _datastore = __import__(_config.get('datastore_driver', default = 'sqlite_datastore'))
 
 _EPERM = 1
+_BLOCKING_FUNCS = {'connection_get', 'connection_get_many', 'messages_get', 'exit_wait', 'datastore_invalidations',
+                   'datastore_watch'}
+# Calls that wait on an HTTP client or remote server for as long as it takes.
+# Unlike the blocking functions they can be batched, but they don't run on the
+# shared worker pool so slow peers can't take up every worker.
+_IO_FUNCS = {'connection_read', 'connection_write', 'connection_begin_response', 'connection_close', 'webrequest'}
 
 try:
   import requests as _requests
@@ -12,6 +19,9 @@ except ImportError:
 _secret2ext_name = {}
 _ext_name2secret = {}
 _connections = {}
+_routes = {}
+_pending_requests = {}
+_static_mounts = {}
 _connection_lock = _threading.Lock()
 _files = {}
 _file_lock = _threading.Lock()
@@ -19,6 +29,8 @@ _extension_options = {}
 _inboxes = {}
 _inbox_lock = _threading.Lock()
 _exit_events = {}
+_cache_subscribers = {}
+_cache_lock = _threading.Lock()
 _logging_lock = _threading.Lock()
 
 def _b2a(b):
@@ -42,12 +54,21 @@ def _get_secret(ext_name):
   return _ext_name2secret[ext_name]
 
 def _cleanup(name):
+  # Cache subscribers go first since invalidating checks their secret
+  with _cache_lock:
+    subscriber = _cache_subscribers.pop(name, None)
+  if subscriber:
+    subscriber['ready'].set()
   secret = _ext_name2secret.pop(name)
   _secret2ext_name.pop(secret)
   with _connection_lock:
     for handle in list(_connections.keys()):
       if _connections[handle]['ext_name'] == name:
         _connections.pop(handle)
+    _routes.pop(name, None)
+    _static_mounts.pop(name, None)
+    for waiter in _pending_requests.pop(name, []):
+      waiter['ready'].set()
   with _file_lock:
     for handle in list(_files.keys()):
       if _files[handle]['ext_name'] == name:
@@ -63,93 +84,353 @@ def _extension_options_set(secret, option, value):
 def extension_options_get(secret, option):
   return _extension_options[secret][option]
 
+_REGEX_SPECIAL = '.^$*+?{}[]\\|()'
+
+def _literal_prefix(pattern):
+  if '|' in pattern:
+    return ''
+  prefix = []
+  for ch in pattern:
+    if ch in _REGEX_SPECIAL:
+      if ch in '*?{' and prefix:
+        # The quantifier makes the preceding character optional
+        prefix.pop()
+      break
+    prefix.append(ch)
+  return ''.join(prefix)
+
+def _connection_get_route(name, method, route):
+  routes = _routes.setdefault(name, {})
+  try:
+    return routes[(method, route)]
+  except KeyError:
+    entry = {
+             'method': method,
+             'route': route,
+             'method_regex': _re.compile(method),
+             'route_regex': _re.compile(route),
+             'prefix': _literal_prefix(route),
+             'idle': _collections.deque(),
+             'listener': None,
+             'busy': 0,
+            }
+    routes[(method, route)] = entry
+    return entry
+
+def _connection_prune_route(name, entry):
+  if not entry['idle'] and not entry['listener'] and entry['busy'] < 1:
+    routes = _routes.get(name, {})
+    if routes.get((entry['method'], entry['route'])) is entry:
+      routes.pop((entry['method'], entry['route']))
+
+def _connection_has_slot(entry):
+  listener = entry['listener']
+  return entry['idle'] or (listener and listener['in_flight'] < listener['slots'])
+
+def _connection_find_route(name, method, route):
+  busy = False
+  for entry in _routes.get(name, {}).values():
+    if (route.startswith(entry['prefix']) and
+        entry['method_regex'].match(method) and
+        entry['route_regex'].match(route)
+       ):
+         if _connection_has_slot(entry):
+           return entry, busy
+         busy = busy or entry['busy'] > 0
+  return None, busy
+
+def _connection_new(name, method, route):
+  handle = _secure_token()
+  c = {
+       'handle': handle,
+       'ready': _threading.Event(),
+       'method': method,
+       'route': route,
+       'ext_name': name
+      }
+  _connections[handle] = c
+  return c
+
+def _connection_take_slot(entry):
+  if entry['idle']:
+    return entry['idle'].popleft()
+  # Standing listeners are refilled here on the host so the extension
+  # doesn't need a round trip per request to re-arm its slots
+  listener = entry['listener']
+  c = _connection_new(listener['ext_name'], entry['method'], entry['route'])
+  c['listener'] = listener
+  listener['in_flight'] += 1
+  listener['delivered'].append(c)
+  listener['ready'].set()
+  return c
+
+def _connection_dispatch(entry, connection, request):
+  connection['request'] = request
+  connection['done'] = _threading.Event()
+  connection['entry'] = entry
+  connection['dispatched'] = _time.perf_counter()
+  connection['status'] = None
+  connection['bytes_in'] = 0
+  connection['bytes_out'] = 0
+  entry['busy'] += 1
+  connection['ready'].set()
+
+def _connection_take_pending(name, entry):
+  pending = _pending_requests.get(name)
+  if pending:
+    for waiter in pending:
+      if (waiter['route'].startswith(entry['prefix']) and
+          entry['method_regex'].match(waiter['request'].command) and
+          entry['route_regex'].match(waiter['route'])
+         ):
+           pending.remove(waiter)
+           return waiter
+  return None
+
+def _connection_fill_slots(name, entry):
+  while _connection_has_slot(entry):
+    waiter = _connection_take_pending(name, entry)
+    if not waiter:
+      return
+    waiter['connection'] = _connection_take_slot(entry)
+    _connection_dispatch(entry, waiter['connection'], waiter['request'])
+    waiter['ready'].set()
+
+def _connection_wait_timeout():
+  retry_count = _config.get_int('connection_retry_count', default=50)
+  retry_delay = _config.get_float('connection_retry_delay', default=0.1)
+  return _config.get_float('connection_wait_timeout', default=retry_count*retry_delay)
+
+def _metrics_record(name, route, status, queue_wait, handler_time, bytes_in=0, bytes_out=0):
+  if queue_wait is not None:
+    _metrics.histogram('sessen_http_queue_wait_seconds', 'Time requests waited for a free handler',
+                       extension=name, route=route).observe(queue_wait)
+  _metrics.histogram('sessen_http_handler_seconds', 'Time from a handler receiving a request until it closed it',
+                     extension=name, route=route).observe(handler_time)
+  # Handlers that closed without beginning a response sent no status code
+  _metrics.counter('sessen_http_responses_total', 'Responses sent by status code',
+                   extension=name, route=route, code='aborted' if status is None else str(status)).add()
+  if bytes_in:
+    _metrics.counter('sessen_http_received_bytes_total', 'Request body bytes read by handlers',
+                     extension=name, route=route).add(bytes_in)
+  if bytes_out:
+    _metrics.counter('sessen_http_sent_bytes_total', 'Response body bytes written by handlers',
+                     extension=name, route=route).add(bytes_out)
+
+def _rpc_function_label(func):
+  # Only real API functions get their own series so callers can't create unbounded labels
+  if type(func) is str and func[:1] != '_' and callable(globals().get(func)):
+    return func
+  return 'unknown'
+
+def _rpc_record(name, func, seconds, error=False, bytes_in=0, bytes_out=0):
+  labels = {'extension': name or '', 'function': func}
+  _metrics.counter('sessen_rpc_calls_total', 'API calls made by extensions', **labels).add()
+  _metrics.histogram('sessen_rpc_seconds', 'Time spent running API calls', **labels).observe(seconds)
+  if error:
+    _metrics.counter('sessen_rpc_errors_total', 'API calls that raised an exception', **labels).add()
+  if bytes_in:
+    _metrics.counter('sessen_rpc_received_bytes_total', 'Bytes of API calls received from extensions', **labels).add(bytes_in)
+  if bytes_out:
+    _metrics.counter('sessen_rpc_sent_bytes_total', 'Bytes of API replies sent to extensions', **labels).add(bytes_out)
+  threshold = _config.get_float('rpc_slow_call_threshold', default=0.0)
+  if threshold and seconds >= threshold and func not in _BLOCKING_FUNCS:
+    _logging.getLogger('sessen').warning('Slow API call from %s: %s took %.3fs', name, func, seconds)
+
+def _serve_admin(request, route):
+  allowed_clients = _config.get_list('metrics_allowed_clients', default=['127.0.0.1', '::1', '::ffff:127.0.0.1'])
+  if (route.split('?')[0] != '/metrics' or not _config.get_bool('metrics', default=True) or
+      request.client_address[0] not in allowed_clients):
+    request.send_error(404)
+    return
+  body = _metrics.render().encode()
+  request.send_response(200)
+  request.send_header('Content-Type', 'text/plain; version=0.0.4')
+  request.send_header('Content-Length', str(len(body)))
+  request.end_headers()
+  request.wfile.write(body)
+
 def _connection_route(request):
+  start = _time.perf_counter()
   sp = request.path.split('/')
   name = sp[1]
+  route = '/'+'/'.join(sp[2:])
+  if name == '_sessen':
+    _serve_admin(request, route)
+    return
   _extension_manager.start_extension(name)
   if name not in _ext_name2secret:
     request.send_error(404)
     return
-  route = '/'+'/'.join(sp[2:])
-  connection = None
-  retry_count = _config.get_int('connection_retry_count', default=50)
-  retry_delay = _config.get_float('connection_retry_delay', default=0.1)
+  for prefix, folder in _static_mounts.get(name, {}).items():
+    if route.startswith(prefix):
+      status = _static_files.serve(request, folder, route[len(prefix):])
+      _metrics_record(name, prefix, status, None, _time.perf_counter()-start)
+      return
+  waiter = {
+            'request': request,
+            'route': route,
+            'ready': _threading.Event(),
+            'connection': None,
+           }
   handler_available_but_busy = False
-  while not connection:
-    for _ in range(retry_count):
-      with _connection_lock:
-        for handle, c in _connections.items():
-          if (name == c['ext_name'] and
-              _re.match(c['method'], request.command) and
-              _re.match(c['route'], route)
-             ):
-               if c['ready'].is_set():
-                 handler_available_but_busy = True
-               else:
-                 connection = c
-                 connection['request'] = request
-                 connection['done'] = _threading.Event()
-                 connection['ready'].set()
-                 break
-      if connection:
+  with _connection_lock:
+    entry, busy = _connection_find_route(name, request.command, route)
+    if entry:
+      waiter['connection'] = _connection_take_slot(entry)
+      _connection_dispatch(entry, waiter['connection'], request)
+    else:
+      # Whether a matching handler existed when the request was parked decides
+      # between 503 and 404 if none frees up, whatever the route looks like later
+      handler_available_but_busy = busy
+      _pending_requests.setdefault(name, _collections.deque()).append(waiter)
+  wait_timeout = _connection_wait_timeout()
+  while not waiter['connection']:
+    waiter['ready'].wait(wait_timeout)
+    with _connection_lock:
+      if waiter['connection']:
         break
-      _time.sleep(retry_delay)
-    if not handler_available_but_busy or not _config.get_bool('busy_connection_waiting', default=True):
-      break
+      _, busy = _connection_find_route(name, request.command, route)
+      handler_available_but_busy = handler_available_but_busy or busy
+      if (not busy or not _config.get_bool('busy_connection_waiting', default=True) or
+          name not in _ext_name2secret):
+        try:
+          _pending_requests[name].remove(waiter)
+        except (KeyError, ValueError):
+          pass
+        break
+  connection = waiter['connection']
   if connection:
     connection['done'].wait()
+    finished = _time.perf_counter()
+    _metrics_record(name, connection.get('metrics_route', connection['route']), connection['status'],
+                    connection['dispatched']-start, finished-connection['dispatched'],
+                    connection['bytes_in'], connection['bytes_out'])
     with _connection_lock:
-      _connections.pop(handle)
+      _connections.pop(connection['handle'], None)
+      entry = connection['entry']
+      entry['busy'] -= 1
+      if 'listener' in connection:
+        connection['listener']['in_flight'] -= 1
+        _connection_fill_slots(name, entry)
+      _connection_prune_route(name, entry)
   elif handler_available_but_busy:
     request.send_response(503)
     request.send_header('Retry-After', str(_config.get_int('busy_connection_retry_delay', 20)))
     request.end_headers()
+    _metrics_record(name, '', 503, _time.perf_counter()-start, 0.0)
   else:
     request.send_error(404)
+    _metrics_record(name, '', 404, _time.perf_counter()-start, 0.0)
     return None
 
+def _connection_info(c):
+  return {
+          'handle': c['handle'],
+          'path': c['request'].path[len(c['ext_name'])+1:],
+          'method': c['request'].command,
+          'method_regex': c['method'],
+          'route_regex': c['route'],
+          'headers': str(c['request'].headers),
+          'client_address': c['request'].client_address,
+         }
+
 
 def connection_get(secret, method, route):
   name = _get_ext_name(secret)
-  handle = _secure_token()
-  c = {
-       'ready': _threading.Event(),
-       'method': method,
-       'route': route,
-       'ext_name': name
-      }
-  with _connection_lock:    
-    _connections[handle] = c
+  with _connection_lock:
+    entry = _connection_get_route(name, method, route)
+    c = _connection_new(name, method, route)
+    entry['idle'].append(c)
+    _connection_fill_slots(name, entry)
   c['ready'].wait()
-  d = {
-       'handle': handle,
-       'path': c['request'].path[len(name)+1:],
-       'method': c['request'].command,
-       'method_regex': c['method'],
-       'route_regex': c['route'],
-       'headers': str(c['request'].headers),
-       'client_address': c['request'].client_address,
-      }
-  return d
+  return _connection_info(c)
+
+def connection_get_many(secret, method, route, n):
+  name = _get_ext_name(secret)
+  n = min(n, _config.get_int('connection_slots_max', default=64))
+  with _connection_lock:
+    entry = _connection_get_route(name, method, route)
+    listener = entry['listener']
+    if n < 1:
+      if listener:
+        entry['listener'] = None
+        listener['ready'].set()
+        _connection_prune_route(name, entry)
+      return []
+    if not listener:
+      listener = {
+                  'ext_name': name,
+                  'slots': n,
+                  'in_flight': 0,
+                  'delivered': _collections.deque(),
+                  'ready': _threading.Event(),
+                 }
+      entry['listener'] = listener
+    listener['slots'] = n
+    _connection_fill_slots(name, entry)
+  while True:
+    listener['ready'].wait()
+    with _connection_lock:
+      delivered = list(listener['delivered'])
+      listener['delivered'].clear()
+      listener['ready'].clear()
+      if delivered or entry['listener'] is not listener:
+        return [_connection_info(c) for c in delivered]
+
+def _static_validate_folder(secret, path):
+  # Everything below a mounted folder is served, so unlike other file access
+  # the folder must be inside an allowed path, not just an ancestor of one.
+  # Links are resolved first so one can't point the mount elsewhere.
+  name = _get_ext_name(secret)
+  folder = _os.path.realpath(_file_validate_path(secret, path, False))
+  permissions = _permissions.get(name)
+  for allowed_path in permissions['allowed_write_files'] + permissions['allowed_read_files']:
+    allowed_path = _os.path.realpath(allowed_path)
+    if _os.path.commonpath([allowed_path, folder]) == allowed_path:
+      return folder
+  raise PermissionError(_EPERM, 'Inaccessible file path', path)
+
+def static_mount(secret, route, path):
+  name = _get_ext_name(secret)
+  folder = _static_validate_folder(secret, path)
+  route = ('/' + route.strip('/') + '/').replace('//', '/')
+  with _connection_lock:
+    mounts = dict(_static_mounts.get(name, {}))
+    mounts[route] = folder
+    # Longest prefixes first so nested mounts take precedence
+    _static_mounts[name] = dict(sorted(mounts.items(), key=lambda i: -len(i[0])))
 
 def connection_read(handle, length):
-  request = _connections[handle]['request']
-  return _b2a(request.rfile.read(length))
+  connection = _connections[handle]
+  data = connection['request'].rfile.read(length)
+  connection['bytes_in'] += len(data)
+  return data
 
 def connection_begin_response(handle, code, headers):
-  request = _connections[handle]['request']
-  request.send_response(code)
-  for name, value in headers:
-    request.send_header(name, value)
-  request.end_headers()
+  connection = _connections[handle]
+  connection['status'] = code
+  connection['response'] = _responses.begin(connection['request'], code, headers)
 
 def connection_write(handle, buf):
-  request = _connections[handle]['request']
-  request.wfile.write(_binascii.a2b_base64(buf))
+  connection = _connections[handle]
+  connection['bytes_out'] += len(buf)
+  if connection.get('response'):
+    connection['response'].write(buf)
+  else:
+    connection['request'].wfile.write(buf)
 
-def connection_close(handle):
+def connection_close(handle, route=None):
   connection = _connections[handle]
-  connection['done'].set()
+  # Handlers bound through sessen.bind all wait on a catch-all route, the
+  # extension passes the route it matched so metrics are recorded under it
+  if type(route) is str:
+    connection['metrics_route'] = route
+  try:
+    if connection.get('response'):
+      connection['response'].finish()
+  finally:
+    connection['done'].set()
 
 def _datastore_validate_path(secret, path, write):
   permissions = _permissions.get(_get_ext_name(secret))
@@ -161,25 +442,137 @@ def _datastore_validate_path(secret, path, write):
       return
   raise PermissionError(_EPERM, 'Inaccessible datastore path', path)
 
+def _datastore_validate_paths(secret, paths, write):
+  # Allowed paths end in a slash, so a path is allowed exactly when everything
+  # up to its last slash is and one path per parent only needs to be checked
+  parents = {}
+  for path in paths:
+    if type(path) is not str:
+      raise TypeError('Datastore paths must be strings')
+    parents.setdefault(path[:path.rfind('/')+1] or path, path)
+  for path in parents.values():
+    _datastore_validate_path(secret, path, write)
+
+def _datastore_cache_invalidate(paths, prefix=False):
+  # Tells extensions caching datastore reads that paths changed. Each is only
+  # told about paths it can read, a prefix it can't read is narrowed to the
+  # readable paths under it. Only writes made through the API are seen, so
+  # caches aren't invalidated by ds.py or another process writing the
+  # datastore file directly.
+  if not _cache_subscribers:
+    return
+  limit = _config.get_int('datastore_cache_max_invalidations', default=1000)
+  with _cache_lock:
+    for name, subscriber in _cache_subscribers.items():
+      invalidations = subscriber['invalidations']
+      for path in paths:
+        try:
+          _datastore_validate_path(subscriber['secret'], path, False)
+          invalidations.append([path, prefix])
+        except KeyError:
+          # The extension is being cleaned up
+          break
+        except PermissionError:
+          if prefix:
+            invalidations.extend([i, True] for i in subscriber['readable'] if i.startswith(path))
+      if len(invalidations) > limit:
+        # The extension has fallen behind so have it drop everything instead
+        subscriber['invalidations'] = [None]
+      if subscriber['invalidations']:
+        subscriber['ready'].set()
+
+def datastore_cache_enable(secret):
+  # Starts queueing invalidations for datastore_invalidations to return
+  name = _get_ext_name(secret)
+  permissions = _permissions.get(name)
+  readable = permissions['allowed_write_datastore'] + permissions['allowed_read_datastore']
+  with _cache_lock:
+    if name not in _cache_subscribers:
+      _cache_subscribers[name] = {
+                                  'secret': secret,
+                                  'readable': [i if i.endswith('/') else i+'/' for i in readable],
+                                  'invalidations': [],
+                                  'ready': _threading.Event(),
+                                 }
+
+def datastore_invalidations(secret):
+  # Waits for and returns [path, is_prefix] pairs, None means every cached value is stale
+  subscriber = _cache_subscribers[_get_ext_name(secret)]
+  subscriber['ready'].wait()
+  with _cache_lock:
+    invalidations = subscriber['invalidations']
+    subscriber['invalidations'] = []
+    subscriber['ready'].clear()
+  return invalidations
+
 def datastore_get(secret, path):
   _datastore_validate_path(secret, path, False)
-  return _b2a(_datastore.get(path))
+  return _datastore.get(path)
 
 def datastore_set(secret, path, value):
   _datastore_validate_path(secret, path, True)
-  return _datastore.set(path, _a2b(value))
+  _datastore.set(path, value)
+  _datastore_cache_invalidate([path])
 
 def datastore_delete(secret, path):
   _datastore_validate_path(secret, path, True)
-  return _datastore.delete(path)
+  _datastore.delete(path)
+  _datastore_cache_invalidate([path])
+
+def datastore_get_many(secret, paths):
+  _datastore_validate_paths(secret, paths, False)
+  return _datastore.get_many(paths)
+
+def datastore_set_many(secret, items):
+  # Items are [path, value] pairs or a dict of values by path
+  if hasattr(items, 'items'):
+    items = items.items()
+  items = [(path, value) for path, value in items]
+  _datastore_validate_paths(secret, [path for path, value in items], True)
+  _datastore.set_many(items)
+  _datastore_cache_invalidate(list(dict.fromkeys(path for path, value in items)))
+
+def datastore_delete_prefix(secret, path):
+  _datastore_validate_path(secret, path, True)
+  count = _datastore.delete_prefix(path)
+  _datastore_cache_invalidate([path], prefix=True)
+  return count
 
 def datastore_keys(secret, path, page):
   _datastore_validate_path(secret, path, False)
   return list(_datastore.keys(path, page))
 
+def datastore_keys_page(secret, path, cursor=None, limit=None):
+  # The cursor is the last key of the previous page, it's None once every key was returned
+  _datastore_validate_path(secret, path, False)
+  if cursor is not None and type(cursor) is not str:
+    raise TypeError('Invalid cursor')
+  if limit is None:
+    limit = _datastore.PAGE_SIZE
+  limit = max(1, min(int(limit), _datastore.MAX_PAGE_SIZE))
+  keys = list(_datastore.keys_after(path, cursor, limit))
+  return {'keys': keys, 'cursor': keys[-1] if len(keys) == limit else None}
+
 def datastore_test_and_set(secret, path, value):
   _datastore_validate_path(secret, path, True)
-  return _b2a(_datastore.test_and_set(path, _a2b(value)))
+  try:
+    return _datastore.test_and_set(path, value)
+  finally:
+    # The value is set even when a KeyError says there wasn't an old one
+    _datastore_cache_invalidate([path])
+
+def datastore_watch(secret, path, since_version=None, timeout=None):
+  # Returns {'version': v, 'keys': [...]} once keys starting with path change
+  # after since_version, or with no keys on timeout. Keys is None if the
+  # changes are no longer known and the caller should reread everything.
+  _datastore_validate_path(secret, path, False)
+  if since_version is not None and type(since_version) is not int:
+    raise TypeError('Invalid version')
+  # Waits are capped so one left behind by an extension that exited ends
+  max_timeout = _config.get_float('datastore_watch_max_timeout', default=60)
+  timeout = max_timeout if timeout is None else max(0, min(timeout, max_timeout))
+  version, keys = _datastore.watch(path, since_version, timeout)
+  return {'version': version, 'keys': keys}
 
 def exit_wait(secret):
   name = _get_ext_name(secret)
@@ -242,6 +635,15 @@ def file_open(secret, path, mode, encoding):
     }
     return handle
 
+def file_open_fd(secret, path, mode):
+  # Hands the extension its own descriptor so reads and writes skip the broker,
+  # only possible over the socket transport when sandboxed
+  write = _file_validate_mode(mode)
+  apath = _file_validate_path(secret, path, write)
+  mode = mode.replace('b', '') + 'b'
+  with open(apath, mode, buffering=0) as fh:
+    return _rpc_framing.FileDescriptor(_os.dup(fh.fileno()))
+
 def file_close(handle):
   with _file_lock:
     fh = _files.pop(handle)['fh']
@@ -253,11 +655,10 @@ def file_read(handle, length):
   data = fh.read(length)
   if hasattr(fh, 'encoding'):
     data = data.encode(fh.encoding)
-  return _b2a(data)
+  return data
 
 def file_write(handle, data):
   fh = _files[handle]['fh']
-  data = _a2b(data)
   if hasattr(fh, 'encoding'):
     data = data.decode(fh.encoding)
   fh.write(data)
@@ -374,14 +775,12 @@ def webrequest(secret, method, url, headers, data, ssl_verify, timeout):
   _webrequest_validate_path(secret, url)
   if type(ssl_verify) is not bool:
     raise TypeError('ssl_verify must be bool')
-  if data is not None:
-    data = _a2b(data)
   if _requests:
     res = _requests.request(method, url=url, headers=headers, data=data, verify=ssl_verify, timeout=timeout)
     return {
             'url': res.url,
             'response_code': res.status_code,
-            'data': _b2a(res.content),
+            'data': res.content,
             'headers': dict(res.headers)
            }
   else:
@@ -395,5 +794,5 @@ def webrequest(secret, method, url, headers, data, ssl_verify, timeout):
             'url': res.geturl(),
             'response_code': res.getcode(),
             'info': str(res.info()),
-            'data': _b2a(res.read())
+            'data': res.read()
            }
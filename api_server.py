@@ -1,62 +1,245 @@
-import threading, queue, os, uuid, json
-import api_backend, sandbox, tempdir
+import threading, queue, os, uuid, json, socket, time, concurrent.futures
+import api_backend, config, sandbox, tempdir, rpc_framing
 
-MAX_LENGTH = 1073741824
-
-_lock = threading.Lock()
-
-def setup_pipes():
-  name = 'SESSEN-PIPE-'+str(uuid.uuid4())
-  client_path = os.path.join(tempdir.get_temp_dir(), name+'-CLIENT')
-  server_path = os.path.join(tempdir.get_temp_dir(), name+'-SERVER')
+def setup_pipes(name=None):
+  pipe_name = 'SESSEN-PIPE-'+str(uuid.uuid4())
+  client_path = os.path.join(tempdir.get_temp_dir(), pipe_name+'-CLIENT')
+  server_path = os.path.join(tempdir.get_temp_dir(), pipe_name+'-SERVER')
   os.mkfifo(client_path)
   os.mkfifo(server_path)
   pipes = [client_path, server_path]
-  threading.Thread(target=initialize_unix_pipe, args=pipes, daemon=True).start()
+  threading.Thread(target=initialize_unix_pipe, args=(client_path,server_path,name), daemon=True).start()
   return pipes
 
 
-def initialize_unix_pipe(client_path, server_path):
-  client_pipe = open(client_path, 'r')
-  server_pipe = open(server_path, 'w')
-  input_worker(client_pipe, server_pipe)
+def initialize_unix_pipe(client_path, server_path, name=None):
+  client_pipe = open(client_path, 'rb')
+  server_pipe = open(server_path, 'wb')
+  input_worker(client_pipe, server_pipe, name=name)
 
 
-def initialize_pipes_from_process(proc):
-  in_thread = threading.Thread(target=input_worker, args=(proc.stdout,proc.stdin), daemon=True)
+def initialize_pipes_from_process(proc, name=None):
+  in_thread = threading.Thread(target=input_worker, args=(proc.stdout,proc.stdin,None,name), daemon=True)
   in_thread.start()
 
 
-def input_worker(client_pipe, server_pipe):
-  is_text = hasattr(client_pipe, 'encoding')
-  while True:
+class _Pool(object):
+  # Calls from one extension share a bounded pool. Once every worker is busy
+  # readers stop taking messages off their pipes until one frees up.
+  def __init__(self):
+    size = get_worker_pool_size()
+    self.slots = threading.Semaphore(size)
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=size)
+
+  def submit(self, func, *args):
+    self.slots.acquire()
+    try:
+      self.executor.submit(self._run, func, args)
+    except RuntimeError:
+      self.slots.release()
+      raise
+
+  def _run(self, func, args):
+    try:
+      func(*args)
+    finally:
+      self.slots.release()
+
+  def close(self):
+    self.executor.shutdown(wait=False)
+
+
+class _Session(object):
+  # Replies are written by a single writer per pipe so a stalled extension
+  # only holds up its own replies.
+  def __init__(self, server_pipe, protocol, pool, name=None):
+    self.server_pipe = server_pipe
+    self.protocol = protocol
+    self.pool = pool
+    self.name = name
+    self.replies = queue.Queue()
+    self.writer = threading.Thread(target=self._write_replies, daemon=True)
+    self.writer.start()
+
+  def dispatch(self, i, size=0):
+    funcs = []
+    if type(i) is dict:
+      calls = i['batch'] if type(i.get('batch')) is list else [i]
+      funcs = [c.get('func') for c in calls if type(c) is dict]
+    if any(func in api_backend._BLOCKING_FUNCS or func in api_backend._IO_FUNCS for func in funcs):
+      # Long waits get their own threads so they can't tie up the pool
+      threading.Thread(target=api_call_worker, args=(i,self,size), daemon=True).start()
+      return
+    self.pool.submit(api_call_worker, i, self, size)
+
+  def reply(self, message, record=None):
+    self.replies.put((message, record))
+
+  def _encode(self, message):
+    # Replies are encoded on the writer thread so workers don't hold a lock to
+    # keep their parts together
+    try:
+      return self.protocol.encode(message)
+    except (TypeError, ValueError) as e:
+      return self.protocol.encode({'id': message['id'], 'result': None, 'exception': repr(e)})
+
+  def _write_replies(self):
+    running = True
+    while running:
+      messages = [self.replies.get()]
+      # Replies that queued up while the last flush was in progress go out together
+      while messages[-1] is not None:
+        try:
+          messages.append(self.replies.get_nowait())
+        except queue.Empty:
+          break
+      if messages[-1] is None:
+        messages.pop()
+        running = False
+      try:
+        for message, record in messages:
+          for part in self._encode(message):
+            self.server_pipe.write(part)
+          if record:
+            func, seconds, error, bytes_in = record
+            api_backend._rpc_record(self.name, func, seconds, error, bytes_in, self.protocol.encoded_size)
+        self.server_pipe.flush()
+      except (OSError, ValueError):
+        # The extension has gone away, keep draining until the session closes
+        pass
+
+  def close(self):
+    self.replies.put(None)
+
+
+def get_worker_pool_size():
+  return max(1, config.get_int('api_worker_pool_size', default=8))
+
+
+def get_socket_stream_count():
+  # Extra streams only help when large transfers hold up small calls, spreading
+  # calls over them otherwise costs throughput
+  return max(1, config.get_int('api_socket_streams', default=1))
+
+
+def setup_socket(on_close=None, name=None):
+  # The socket transport can give each extension several independent streams
+  # sharing one pool, and lets the host pass open descriptors to it
+  path = os.path.join(tempdir.get_temp_dir(), 'SESSEN-SOCK-'+str(uuid.uuid4()))
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  sock.bind(path)
+  sock.listen()
+  threading.Thread(target=socket_listener, args=(sock,path,on_close,name), daemon=True).start()
+  return path
+
+
+def socket_listener(sock, path, on_close, name=None):
+  pool = _Pool()
+  lock = threading.Lock()
+  streams = []
+  def stream_worker(stream):
     try:
-      buf = client_pipe.readline(MAX_LENGTH)
-      if not buf:
-        return
-      i = json.loads(buf if is_text else buf.decode())
-      t = threading.Thread(target=api_call_worker, args=(i,server_pipe), daemon=True)
-      t.start()
-    except (json.decoder.JSONDecodeError, ValueError, TypeError) as ex:
+      input_worker(stream, stream, pool=pool, name=name)
+    except OSError:
       pass
+    finally:
+      stream.close()
+      with lock:
+        streams.remove(stream)
+        if streams:
+          return
+      # The last stream closing means the extension has gone away
+      sock.close()
+      pool.close()
+      if on_close:
+        on_close()
+  try:
+    for _ in range(get_socket_stream_count()):
+      conn, _ = sock.accept()
+      stream = rpc_framing.SocketStream(conn, accept_fds=False)
+      with lock:
+        streams.append(stream)
+      threading.Thread(target=stream_worker, args=(stream,), daemon=True).start()
+  except OSError:
+    pass
+  finally:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+def input_worker(client_pipe, server_pipe, pool=None, name=None):
+  own_pool = pool is None
+  if own_pool:
+    pool = _Pool()
+  try:
+    try:
+      protocol = rpc_framing.accept(client_pipe)
+    except ValueError:
+      return
+    session = _Session(server_pipe, protocol, pool, name)
+    try:
+      while True:
+        try:
+          i = protocol.read(client_pipe)
+          if i is None:
+            return
+          session.dispatch(i, protocol.read_size)
+        except rpc_framing.FrameError as ex:
+          if ex.id is None:
+            # The caller can't be told so the transport is closed instead
+            # of leaving the call waiting forever
+            return
+          session.reply({'id': ex.id, 'result': None, 'exception': repr(ValueError(str(ex)))})
+    finally:
+      session.close()
+      session.writer.join()
+  finally:
+    if own_pool:
+      pool.close()
+
+
+def call_api(call):
+  func_name = call['func']
+  if func_name[0] == '_':
+    raise RuntimeError("Sanboxed extensions can't call private functions in the API backend")
+  func = getattr(api_backend, func_name)
+  return func(*call['args'], **call['kwargs'])
+
+
+def call_api_batch(calls, name=None):
+  # Calls run in the order they were queued and each gets its own result or exception
+  results = []
+  for call in calls:
+    start = time.perf_counter()
+    try:
+      if call['func'] in api_backend._BLOCKING_FUNCS:
+        raise RuntimeError(call['func'] + " can't be batched")
+      results.append([call_api(call), None])
+    except Exception as e:
+      results.append([None, repr(e)])
+    api_backend._rpc_record(name, api_backend._rpc_function_label(call.get('func')),
+                            time.perf_counter()-start, results[-1][1] is not None)
+  return results
 
 
-def api_call_worker(i, server_pipe):
+def api_call_worker(i, session, bytes_in=0):
   try:
     id = i['id']
   except (KeyError, TypeError):
     print("DBG BAD JSON", i)
     return
   r, ex = None, None
+  start = time.perf_counter()
   try:
-    func_name = i['func']
-    if func_name[0] == '_':
-      raise RuntimeError("Sanboxed extensions can't call private functions in the API backend")
-    func = getattr(api_backend, func_name)
-    r = func(*i['args'], **i['kwargs'])
+    if 'batch' in i:
+      func = 'batch'
+      r = call_api_batch(i['batch'], session.name)
+    else:
+      func = api_backend._rpc_function_label(i.get('func'))
+      r = call_api(i)
   except Exception as e:
     ex = repr(e)
-  with _lock:
-    j = json.dumps({'id': id, 'result': r, 'exception': ex})+'\n'
-    server_pipe.write(j if hasattr(server_pipe, 'encoding') else j.encode())
-    server_pipe.flush()
+  # Counts and latency are recorded once the reply is encoded so its size is known
+  session.reply({'id': id, 'result': r, 'exception': ex}, (func, time.perf_counter()-start, ex is not None, bytes_in))
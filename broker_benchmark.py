@@ -0,0 +1,237 @@
+help_text = """
+broker_benchmark.py measures the throughput and latency of the API broker.
+
+It starts api_server over each requested transport, launches a client process
+that uses api_client the same way a sandboxed extension does and times API
+calls from 1 to 64 client threads. Results are printed or written as JSON so
+runs from different commits can be compared.
+
+Transports:
+  fifo-json - the FIFO pair with the JSON lines protocol
+  fifo      - the FIFO pair with length-prefixed frames
+  socket    - the Unix domain socket transport
+
+Here are some examples:
+  broker_benchmark.py
+  broker_benchmark.py --transports fifo socket --threads 1 16 --duration 5
+  broker_benchmark.py --set api_worker_pool_size=16 --output results.json
+"""
+
+import sys, os, json, time, threading, subprocess, tempfile, platform, argparse
+
+BENCH_NAME = 'broker_benchmark'
+SINK_NAME = 'broker_benchmark_sink'
+TRANSPORTS = ['fifo-json', 'fifo', 'socket']
+OPERATIONS = ['datastore_get', 'datastore_set', 'file_read_4k', 'file_read_64k', 'file_read_1m',
+              'connection_write', 'messages_send']
+THREADS = [1, 4, 16, 64]
+FILE_SIZES = {'file_read_4k': 4*1024, 'file_read_64k': 64*1024, 'file_read_1m': 1024**2}
+VALUE_SIZE = 100
+WRITE_SIZE = 4*1024
+
+class _NullFile(object):
+  def write(self, data):
+    return len(data)
+
+  def flush(self):
+    pass
+
+class _NullRequest(object):
+  def __init__(self):
+    self.wfile = _NullFile()
+
+def _set_config(overrides):
+  import config
+  cached = config.load()
+  for item in overrides:
+    key, _, value = item.partition('=')
+    cached[key] = value
+
+def _setup_host(args, temp_dir):
+  sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandboxed_libs'))
+  import config
+  _set_config(['datastore_path='+os.path.join(temp_dir, 'datastore.db')] + args.set)
+  import api_backend, extension_manager
+
+  # Validation and permissions are bypassed the same way ds.py does it, this
+  # only measures the broker
+  extension_manager.start_extension = lambda *a, **k: None
+  api_backend._datastore_validate_path = lambda *a: None
+  api_backend._file_validate_path = lambda secret, path, write: path
+  api_backend.messages_list_recipients = lambda secret: [SINK_NAME]
+  secret = api_backend._secure_token()
+  api_backend._register_ext_name(secret, BENCH_NAME)
+
+  files = {}
+  for operation, size in FILE_SIZES.items():
+    path = os.path.join(temp_dir, operation)
+    with open(path, 'wb') as f:
+      f.write(os.urandom(size*16))
+    files[operation] = path
+  handles = []
+  for i in range(max(args.threads)):
+    handle = api_backend._secure_token()
+    api_backend._connections[handle] = {'request': _NullRequest(), 'ext_name': BENCH_NAME,
+                                        'bytes_in': 0, 'bytes_out': 0, 'done': threading.Event()}
+    handles.append(handle)
+
+  def drain_sink():
+    while True:
+      time.sleep(0.5)
+      with api_backend._inbox_lock:
+        api_backend._inboxes.pop(SINK_NAME, None)
+  threading.Thread(target=drain_sink, daemon=True).start()
+  return secret, {'files': files, 'handles': handles}
+
+def _start_transport(transport):
+  import api_server, rpc_framing
+  env = {'SESSEN_PROTOCOL': '1' if transport == 'fifo-json' else str(rpc_framing.VERSION)}
+  if transport == 'socket':
+    env['SESSEN_SOCKET'] = api_server.setup_socket(name=BENCH_NAME)
+    env['SESSEN_SOCKET_STREAMS'] = str(api_server.get_socket_stream_count())
+    return env
+  env['SESSEN_PIPE0'], env['SESSEN_PIPE1'] = api_server.setup_pipes(BENCH_NAME)
+  return env
+
+def _run_client(transport, secret, spec, temp_dir):
+  env = dict(os.environ)
+  env.update(_start_transport(transport))
+  env['SESSEN_NAME'] = BENCH_NAME
+  env['SESSEN_SECRET'] = secret
+  env['PYTHONPATH'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sandboxed_libs')
+  proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--client', json.dumps(spec)],
+                        env=env, stdout=subprocess.PIPE, check=True)
+  return json.loads(proc.stdout)
+
+def _percentile(values, p):
+  if not values:
+    return None
+  return values[min(len(values)-1, int(p*len(values)))]
+
+def _client_operation(api_client, secret, spec, operation, index):
+  # Returns the call to time, with any setup done up front
+  if operation == 'datastore_get':
+    path = 'extensions/%s/get' % BENCH_NAME
+    return lambda: api_client.datastore_get(secret, path)
+  if operation == 'datastore_set':
+    path = 'extensions/%s/set/%d' % (BENCH_NAME, index)
+    value = os.urandom(VALUE_SIZE)
+    return lambda: api_client.datastore_set(secret, path, value)
+  if operation in FILE_SIZES:
+    size = FILE_SIZES[operation]
+    handle = api_client.file_open(secret, spec['files'][operation], 'rb', None)
+    def read():
+      if len(api_client.file_read(handle, size)) < size:
+        api_client.file_seek(handle, 0, 0)
+    return read
+  if operation == 'connection_write':
+    handle = spec['handles'][index]
+    data = os.urandom(WRITE_SIZE)
+    return lambda: api_client.connection_write(handle, data)
+  if operation == 'messages_send':
+    message = {'index': index, 'data': 'x'*VALUE_SIZE}
+    return lambda: api_client.messages_send(secret, SINK_NAME, message)
+  raise ValueError('Unknown operation: ' + operation)
+
+def client_main(spec):
+  import api_client
+  secret = os.environ['SESSEN_SECRET']
+  api_client.datastore_set(secret, 'extensions/%s/get' % BENCH_NAME, os.urandom(VALUE_SIZE))
+  results = []
+  for operation in spec['operations']:
+    for thread_count in spec['threads']:
+      calls = [_client_operation(api_client, secret, spec, operation, i) for i in range(thread_count)]
+      latencies = [[] for _ in range(thread_count)]
+      errors = [0]
+      # Timing starts once every thread has finished warming up
+      timing = {}
+      def start_clock():
+        timing['start'] = time.perf_counter()
+        timing['deadline'] = timing['start'] + spec['duration']
+      ready = threading.Barrier(thread_count+1, action=start_clock)
+      def worker(call, samples):
+        for _ in range(spec['warmup']):
+          call()
+        ready.wait()
+        deadline = timing['deadline']
+        while time.perf_counter() < deadline:
+          t = time.perf_counter()
+          try:
+            call()
+          except Exception:
+            errors[0] += 1
+          samples.append(time.perf_counter()-t)
+      threads = [threading.Thread(target=worker, args=i, daemon=True) for i in zip(calls, latencies)]
+      for t in threads:
+        t.start()
+      ready.wait()
+      for t in threads:
+        t.join()
+      elapsed = time.perf_counter() - timing['start']
+      samples = sorted((i for l in latencies for i in l))
+      results.append({
+                      'operation': operation,
+                      'threads': thread_count,
+                      'ops': len(samples),
+                      'errors': errors[0],
+                      'ops_per_sec': len(samples)/elapsed,
+                      'p50_ms': _percentile(samples, 0.5)*1000 if samples else None,
+                      'p99_ms': _percentile(samples, 0.99)*1000 if samples else None,
+                     })
+  print(json.dumps(results))
+
+def _git_revision():
+  try:
+    return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+  except OSError:
+    return None
+
+def main():
+  if len(sys.argv) > 2 and sys.argv[1] == '--client':
+    client_main(json.loads(sys.argv[2]))
+    return
+
+  parser = argparse.ArgumentParser(description=help_text, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--transports', nargs='+', default=TRANSPORTS, choices=TRANSPORTS)
+  parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+  parser.add_argument('--threads', nargs='+', type=int, default=THREADS)
+  parser.add_argument('--duration', type=float, default=2.0, help='Seconds to run each operation and thread count for')
+  parser.add_argument('--warmup', type=int, default=20, help='Calls each thread makes before timing starts')
+  parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='Override a config option')
+  parser.add_argument('--output', '-o', help='Write the JSON results to a file instead of printing them')
+  args = parser.parse_args()
+
+  if platform.system() == 'Windows':
+    print('broker_benchmark.py needs FIFOs or Unix domain sockets and does not run on Windows')
+    return
+
+  with tempfile.TemporaryDirectory(prefix='sessen-benchmark-') as temp_dir:
+    secret, spec = _setup_host(args, temp_dir)
+    spec.update(operations=args.operations, threads=args.threads, duration=args.duration, warmup=args.warmup)
+    results = []
+    for transport in args.transports:
+      for result in _run_client(transport, secret, spec, temp_dir):
+        result['transport'] = transport
+        results.append(result)
+        print('%-10s %-17s %3d threads %10.0f ops/s  p50 %8.3f ms  p99 %8.3f ms' % (
+              transport, result['operation'], result['threads'], result['ops_per_sec'],
+              result['p50_ms'] or 0, result['p99_ms'] or 0), file=sys.stderr)
+
+  report = {
+            'revision': _git_revision(),
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'config': args.set,
+            'duration': args.duration,
+            'results': results,
+           }
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+  else:
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+  main()
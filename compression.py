@@ -0,0 +1,178 @@
+import os, gzip, zlib, hashlib, threading, uuid
+import config, tempdir
+
+COMPRESSIBLE_TYPES = ['text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/xhtml+xml', 'application/wasm', 'image/svg+xml', 'image/x-icon']
+ENCODINGS = ['gzip', 'deflate']
+HASH_CACHE_SIZE = 4096
+
+_hash_cache = {}
+_hash_lock = threading.Lock()
+
+def enabled():
+  return config.get_bool('compression', default=True)
+
+def get_min_size():
+  return config.get_int('compression_min_size', default=1024)
+
+def get_max_size():
+  return config.get_int('compression_max_size', default=8*1024**2)
+
+def get_level():
+  return config.get_int('compression_level', default=6)
+
+def get_cache_dir():
+  try:
+    return os.path.expandvars(config.get('compression_cache_dir'))
+  except KeyError:
+    return os.path.join(tempdir.get_or_create_temp_dir(), 'sessen-compression-cache')
+
+def is_compressible(content_type):
+  if not content_type:
+    return False
+  content_type = content_type.split(';')[0].strip().lower()
+  return any((content_type.startswith(i) for i in COMPRESSIBLE_TYPES))
+
+def choose_encoding(accept_encoding):
+  if not enabled() or not accept_encoding:
+    return None
+  accepted = {}
+  for item in accept_encoding.split(','):
+    name, _, params = item.partition(';')
+    q = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        q = float(params[2:])
+      except ValueError:
+        q = 0.0
+    accepted[name.strip().lower()] = q
+  best, best_q = None, 0.0
+  for encoding in ENCODINGS:
+    q = accepted.get(encoding, accepted.get('*', 0.0))
+    if q > best_q:
+      best, best_q = encoding, q
+  return best
+
+def compress(data, encoding):
+  if encoding == 'gzip':
+    return gzip.compress(data, compresslevel=get_level(), mtime=0)
+  return zlib.compress(data, get_level())
+
+def _hash_file(path, stat):
+  key = (path, stat.st_mtime_ns, stat.st_size)
+  with _hash_lock:
+    try:
+      return _hash_cache[key]
+    except KeyError:
+      pass
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    while True:
+      buf = f.read(1024**2)
+      if not buf:
+        break
+      h.update(buf)
+  digest = h.hexdigest()
+  with _hash_lock:
+    if len(_hash_cache) >= HASH_CACHE_SIZE:
+      _hash_cache.pop(next(iter(_hash_cache)))
+    _hash_cache[key] = digest
+  return digest
+
+def get_precompressed(path, stat, encoding):
+  # Compressed copies are keyed by content hash so renamed or touched files reuse them
+  cache_dir = get_cache_dir()
+  cache_path = os.path.join(cache_dir, _hash_file(path, stat) + '.' + encoding)
+  try:
+    if not os.path.exists(cache_path):
+      with open(path, 'rb') as f:
+        data = compress(f.read(), encoding)
+      if len(data) >= stat.st_size:
+        data = b''
+      os.makedirs(cache_dir, exist_ok=True)
+      tmp_path = cache_path + '.' + str(uuid.uuid4())
+      with open(tmp_path, 'wb') as f:
+        f.write(data)
+      os.replace(tmp_path, cache_path)
+    if os.path.getsize(cache_path) < 1:
+      # An empty entry records that compressing the file didn't make it smaller
+      return None
+  except OSError:
+    return None
+  return cache_path
+
+def get_header(headers, name):
+  name = name.lower()
+  for key, value in headers:
+    if key.lower() == name:
+      return str(value)
+  return None
+
+def add_vary(headers):
+  # Returns the headers with Accept-Encoding listed in Vary, merged into an
+  # existing Vary header so caches keep varying on what the handler asked for
+  headers = list(headers)
+  tokens = []
+  first = None
+  for i, (key, value) in enumerate(headers):
+    if key.lower() == 'vary':
+      tokens.extend(t.strip().lower() for t in str(value).split(','))
+      if first is None:
+        first = i
+  if '*' in tokens or 'accept-encoding' in tokens:
+    return headers
+  if first is None:
+    headers.append(('Vary', 'Accept-Encoding'))
+  else:
+    key, value = headers[first]
+    headers[first] = (key, '%s, Accept-Encoding' % value if str(value).strip() else 'Accept-Encoding')
+  return headers
+
+class BufferedResponse(object):
+  def __init__(self, request, code, headers, encoding, length):
+    self.request = request
+    self.code = code
+    self.headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+    self.encoding = encoding
+    self.length = length
+    self.chunks = []
+    self.size = 0
+    self.finished = False
+
+  def write(self, data):
+    self.chunks.append(data)
+    self.size += len(data)
+    if self.size >= self.length:
+      self.finish()
+
+  def finish(self):
+    if self.finished:
+      return
+    self.finished = True
+    body = compress(b''.join(self.chunks), self.encoding)
+    self.chunks = []
+    request = self.request
+    request.send_response(self.code)
+    for name, value in self.headers:
+      request.send_header(name, value)
+    request.send_header('Content-Encoding', self.encoding)
+    request.send_header('Content-Length', str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+def buffer_response(request, code, headers):
+  if code < 200 or code in (204, 206, 304) or request.command == 'HEAD':
+    return None
+  if get_header(headers, 'Content-Encoding') or not is_compressible(get_header(headers, 'Content-Type')):
+    return None
+  try:
+    length = int(get_header(headers, 'Content-Length'))
+  except (TypeError, ValueError):
+    return None
+  if length < get_min_size() or length > get_max_size():
+    return None
+  encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+  if not encoding:
+    return None
+  return BufferedResponse(request, code, add_vary(headers), encoding, length)
@@ -3,11 +3,15 @@ ds.py is a small utility for managing Sessen's datastore from a command line.
 
 It supports the following commands:
   get       - retrieve and print a path
+  get_many  - retrieve and print several paths in one read
   set       - set a path to a string
   set_int   - set a path to an int
   set_float - set a path to a float
+  set_many  - set several paths to strings in one write, given as
+              path value pairs
   del       - delete a path
-  keys      - print all keys that start with a path
+  keys      - print all keys that start with a path, optionally fetching
+              a given number of keys at a time
   delkeys   - delete all keys that start with a path
   help      - display this help text
   ?         - same as help
@@ -17,10 +21,13 @@ Here are some examples:
   ds.py set extensions/MyExtension/password "foo bar"
   ds.py set_int extensions/MyExtension/age 92
   ds.py set_float extensions/MyExtension/rate 3.14
+  ds.py get_many extensions/MyExtension/settings extensions/MyExtension/age
+  ds.py set_many extensions/MyExtension/a foo extensions/MyExtension/b bar
   ds.py del extensions/MyExtension/password
-  ds.py key shared
+  ds.py keys shared
+  ds.py keys shared 1000
 
-ds.py key "" can be used to list every key
+ds.py keys "" can be used to list every key
 """
 
 def main():
@@ -33,8 +40,18 @@ def main():
     print(help_text)
   elif sys.argv[1] == 'get':
     print(sessen.datastore[sys.argv[2]])
+  elif sys.argv[1] == 'get_many':
+    missing = object()
+    paths = sys.argv[2:]
+    for path, value in zip(paths, sessen.datastore.get_many(paths, missing)):
+      print(path + ': ' + ('(missing)' if value is missing else str(value)))
   elif sys.argv[1] == 'set':
     sessen.datastore[sys.argv[2]] = sys.argv[3]
+  elif sys.argv[1] == 'set_many':
+    if len(sys.argv) % 2:
+      print('set_many takes pairs of paths and values')
+      sys.exit(1)
+    sessen.datastore.set_many(zip(sys.argv[2::2], sys.argv[3::2]))
   elif sys.argv[1] == 'set_int':
     sessen.datastore[sys.argv[2]] = int(sys.argv[3])
   elif sys.argv[1] == 'set_float':
@@ -42,11 +59,11 @@ def main():
   elif sys.argv[1] == 'del':
     del sessen.datastore[sys.argv[2]]
   elif sys.argv[1] == 'keys':
-    for k in sessen.datastore.keys(sys.argv[2]):
+    page_size = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    for k in sessen.datastore.keys(sys.argv[2], page_size):
       print(k)
   elif sys.argv[1] == 'delkeys':
-    for k in sessen.datastore.keys(sys.argv[2]):
-      del sessen.datastore[k]
+    sessen.datastore.delete_prefix(sys.argv[2])
 
 if __name__ == '__main__':
   main()
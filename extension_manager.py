@@ -1,5 +1,5 @@
 import sys, os, subprocess, threading, time, platform
-import config, permissions, api_backend, api_server, sessen, sandbox, tempdir
+import config, permissions, api_backend, api_server, sessen, sandbox, tempdir, rpc_framing
 
 _running_extensions = {}
 _lock = threading.Lock()
@@ -30,6 +30,17 @@ def prune_stopped_extensions():
       _running_extensions.pop(name)
       api_backend._cleanup(name)
 
+def transport_closed(name):
+  # Release anything still waiting on the extension as soon as it exits rather
+  # than when it's next started
+  proc = _running_extensions.get(name)
+  if proc:
+    try:
+      proc.wait(STOP_EXTENSION_TIMEOUT)
+    except subprocess.TimeoutExpired:
+      return
+  prune_stopped_extensions()
+
 def non_sandboxed_extension_thread(ext_path, name):
   threading.current_thread().extension_name = name
   sessen.import_from_path(ext_path, name)
@@ -51,10 +62,17 @@ def start_extension(name, exclusive=False, force_sandbox=False):
           ext_env = dict(os.environ)
           ext_env['SESSEN_NAME'] = name
           ext_env['SESSEN_SECRET'] = secret
+          ext_env['SESSEN_PROTOCOL'] = str(rpc_framing.VERSION)
+          ext_env['SESSEN_TEMP'] = os.path.join(tempdir.get_or_create_temp_dir(), name)
+          use_socket = platform.system() != 'Windows' and config.get('api_transport', default='fifo') == 'socket'
           if platform.system() == 'Windows':
             pipes = []
+          elif use_socket:
+            pipes = [api_server.setup_socket(lambda: transport_closed(name), name)]
+            ext_env['SESSEN_SOCKET'] = pipes[0]
+            ext_env['SESSEN_SOCKET_STREAMS'] = str(api_server.get_socket_stream_count())
           else:
-            pipes = api_server.setup_pipes()
+            pipes = api_server.setup_pipes(name)
             ext_env['SESSEN_PIPE0'] = pipes[0]
             ext_env['SESSEN_PIPE1'] = pipes[1]
           ext_env['SESSEN_EXT_PATH'] = ext_path
@@ -65,7 +83,6 @@ def start_extension(name, exclusive=False, force_sandbox=False):
           if config.get_bool('no_exception_logging', default=False):
             ext_env['SESSEN_NO_EXCEPTION_LOGGING'] = '1'
           ext_env['SESSEN_BREAKPOINT'] = config.get('breakpoint_handler', default='sdb.breakpoint')
-          ext_env['SESSEN_TEMP'] = os.path.join(tempdir.get_or_create_temp_dir(), name)
 
           _running_extensions[name] = sandbox.run_python(
                 ['-u', 'extension_host.py', name],
@@ -77,7 +94,7 @@ def start_extension(name, exclusive=False, force_sandbox=False):
                 cwd=SANDBOX_SCRIPTS[0])
 
           if platform.system() == 'Windows':
-            api_server.initialize_pipes_from_process(_running_extensions[name])
+            api_server.initialize_pipes_from_process(_running_extensions[name], name)
         else:
           if sys_path not in sys.path:
             sys.path.append(sys_path)
@@ -1,4 +1,4 @@
-import http.server, socketserver, threading, ssl, socket
+import http.server, socketserver, threading, ssl, socket, asyncio, concurrent.futures, io
 import config, api_backend
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
@@ -31,20 +31,225 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 
 class MultiThreadedServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
   daemon_threads = True
+  handshake_timeout = None
+
+  def finish_request(self, request, client_address):
+    if isinstance(request, ssl.SSLSocket):
+      # The handshake is deferred to here so a slow client only holds up its own thread
+      try:
+        request.settimeout(self.handshake_timeout)
+        request.do_handshake()
+        request.settimeout(None)
+      except OSError:
+        return
+    super().finish_request(request, client_address)
+
+class AsyncRequestHandler(RequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def __init__(self, raw_request, client_address, server, wfile):
+    # The request has already been read in full by the event loop so the
+    # usual socketserver setup/handle/finish cycle isn't used
+    self.rfile = io.BytesIO(raw_request)
+    self.wfile = wfile
+    self.client_address = client_address
+    self.server = server
+    self.close_connection = True
+    self.response_framed = False
+
+  def handle_expect_100(self):
+    # AsyncServer already sent the interim response before reading the body
+    return True
+
+  def send_response(self, code, message=None):
+    self.response_framed = (code < 200 or code in (204, 304) or self.command == 'HEAD')
+    super().send_response(code, message)
+
+  def send_header(self, keyword, value):
+    if keyword.lower() in ('content-length', 'transfer-encoding'):
+      self.response_framed = True
+    super().send_header(keyword, value)
+
+  def end_headers(self):
+    if not self.response_framed and not self.close_connection:
+      # Without a length the end of the body can only be signalled by closing
+      self.send_header('Connection', 'close')
+    super().end_headers()
+
+class _StreamWriterFile(object):
+  def __init__(self, loop, writer):
+    self.loop = loop
+    self.writer = writer
+
+  async def _write(self, data):
+    self.writer.write(data)
+    await self.writer.drain()
+
+  def write(self, data):
+    data = bytes(data)
+    asyncio.run_coroutine_threadsafe(self._write(data), self.loop).result()
+    return len(data)
+
+  def flush(self):
+    pass
+
+class _BadRequest(Exception):
+  def __init__(self, code):
+    self.code = code
+
+class AsyncServer(object):
+  MAX_HEADER_SIZE = 65536
+
+  def __init__(self, server_address, ssl_context=None):
+    self.server_address = server_address
+    self.ssl_context = ssl_context
+    self.handshake_timeout = get_handshake_timeout()
+    self.keep_alive_timeout = config.get_float('keep_alive_timeout', default=15.0)
+    self.max_body_size = config.get_int('max_request_body_size', default=64*1024**2)
+    self.executor = concurrent.futures.ThreadPoolExecutor(
+                      max_workers=config.get_int('http_worker_threads', default=256))
+
+  async def _read_body(self, reader, headers):
+    # Lengths are parsed strictly and a request giving both a Content-Length and
+    # a Transfer-Encoding is refused, since a proxy in front could frame it
+    # differently
+    length = None
+    transfer_encoding = None
+    for line in headers.split(b'\r\n')[1:]:
+      name, _, value = line.partition(b':')
+      name = name.strip().lower()
+      if name == b'content-length':
+        value = value.strip()
+        if not value.isdigit() or (length is not None and int(value) != length):
+          raise _BadRequest(400)
+        length = int(value)
+      elif name == b'transfer-encoding':
+        transfer_encoding = value.strip().lower()
+    if transfer_encoding is None:
+      length = length or 0
+      if length > self.max_body_size:
+        raise _BadRequest(413)
+      return headers, await reader.readexactly(length)
+    if length is not None or transfer_encoding != b'chunked':
+      raise _BadRequest(400)
+    chunks = []
+    size = 0
+    while True:
+      size_line = await self._read_line(reader)
+      chunk_size = size_line.split(b';')[0].strip()
+      if not chunk_size or chunk_size.strip(b'0123456789abcdefABCDEF'):
+        raise _BadRequest(400)
+      chunk_size = int(chunk_size, 16)
+      if chunk_size == 0:
+        break
+      size += chunk_size
+      if size > self.max_body_size:
+        raise _BadRequest(413)
+      chunks.append(await reader.readexactly(chunk_size))
+      if await reader.readexactly(2) != b'\r\n':
+        raise _BadRequest(400)
+    while await self._read_line(reader) != b'\r\n':
+      pass
+    # Hand the worker an ordinary request with a known length
+    lines = [i for i in headers.split(b'\r\n')
+             if i.partition(b':')[0].strip().lower() != b'transfer-encoding']
+    lines.insert(-2, b'Content-Length: ' + str(size).encode())
+    return b'\r\n'.join(lines), b''.join(chunks)
+
+  async def _read_line(self, reader):
+    try:
+      return await reader.readuntil(b'\r\n')
+    except asyncio.LimitOverrunError:
+      raise _BadRequest(400)
+
+  async def _read_request(self, reader, writer):
+    try:
+      headers = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keep_alive_timeout)
+    except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+      return None
+    except asyncio.LimitOverrunError:
+      raise _BadRequest(431)
+    if b'\r\nexpect: 100-continue' in headers.lower() and b' HTTP/1.0\r\n' not in headers:
+      writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+    headers, body = await self._read_body(reader, headers)
+    return headers + body
+
+  def _handle_request(self, raw_request, client_address, wfile):
+    handler = AsyncRequestHandler(raw_request, client_address, self, wfile)
+    handler.handle_one_request()
+    return handler
+
+  async def _handle_client(self, reader, writer):
+    loop = asyncio.get_running_loop()
+    client_address = writer.get_extra_info('peername')
+    wfile = _StreamWriterFile(loop, writer)
+    try:
+      while True:
+        try:
+          raw_request = await self._read_request(reader, writer)
+        except _BadRequest as ex:
+          writer.write(('HTTP/1.1 %d %s\r\nConnection: close\r\nContent-Length: 0\r\n\r\n' %
+                        (ex.code, http.server.BaseHTTPRequestHandler.responses[ex.code][0])).encode())
+          break
+        except (asyncio.IncompleteReadError, ConnectionError):
+          break
+        if raw_request is None:
+          break
+        handler = await loop.run_in_executor(self.executor, self._handle_request,
+                                             raw_request, client_address, wfile)
+        if handler.close_connection:
+          break
+    except ConnectionError:
+      pass
+    finally:
+      writer.close()
+
+  async def _serve(self):
+    bind, port = self.server_address
+    server = await asyncio.start_server(self._handle_client, host=bind or None, port=port,
+                                        ssl=self.ssl_context, limit=self.MAX_HEADER_SIZE,
+                                        ssl_handshake_timeout=self.handshake_timeout if self.ssl_context else None)
+    async with server:
+      await server.serve_forever()
+
+  def serve_forever(self):
+    asyncio.run(self._serve())
+
+def get_handshake_timeout():
+  return config.get_float('ssl_handshake_timeout', default=10.0)
+
+def create_ssl_context():
+  context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+  context.load_cert_chain(certfile=config.get('certfile', default='cert.pem'),
+                          keyfile=config.get('keyfile', default='key.pem'))
+  # Session tickets let returning clients resume without a full handshake
+  session_tickets = config.get_int('ssl_session_tickets', default=2)
+  if session_tickets > 0:
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = session_tickets
+  else:
+    context.options |= ssl.OP_NO_TICKET
+    context.num_tickets = 0
+  return context
 
 def serve_forever(bind=None, port=None):
   if port is None:
     port = config.get_int('port', default = 9292)
   if bind is None:
     bind = config.get_int('bind', default = '')
-  httpd = MultiThreadedServer((bind,port), RequestHandler)
-
-  if config.get_bool('use_ssl', default = True):
-    context = ssl.create_default_context()
-    httpd.socket = ssl.wrap_socket(httpd.socket,
-                                   certfile=config.get('certfile', default='cert.pem'),
-                                   keyfile=config.get('keyfile', default='key.pem'),
-                                   server_side=True)
+
+  if config.get('http_server', default='threaded') == 'async':
+    context = create_ssl_context() if config.get_bool('use_ssl', default = True) else None
+    httpd = AsyncServer((bind,int(port)), context)
+  else:
+    httpd = MultiThreadedServer((bind,port), RequestHandler)
+
+    if config.get_bool('use_ssl', default = True):
+      context = create_ssl_context()
+      httpd.socket = context.wrap_socket(httpd.socket,
+                                         server_side=True,
+                                         do_handshake_on_connect=False)
+      httpd.handshake_timeout = get_handshake_timeout()
 
   try:
     httpd.serve_forever()
@@ -0,0 +1,83 @@
+import threading, bisect
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics = {}
+_lock = threading.Lock()
+
+class Histogram(object):
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0]*(len(buckets)+1)
+    self.sum = 0.0
+    self.lock = threading.Lock()
+
+  def observe(self, value):
+    idx = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      self.counts[idx] += 1
+      self.sum += value
+
+  def render(self, name, labels):
+    with self.lock:
+      counts = list(self.counts)
+      total = self.sum
+    lines = []
+    cumulative = 0
+    for bound, count in zip(self.buckets + ('+Inf',), counts):
+      cumulative += count
+      lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', str(bound)),)), cumulative))
+    lines.append('%s_sum%s %s' % (name, _format_labels(labels), repr(total)))
+    lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+    return lines
+
+class Counter(object):
+  def __init__(self):
+    self.value = 0
+    self.lock = threading.Lock()
+
+  def add(self, value=1):
+    with self.lock:
+      self.value += value
+
+  def render(self, name, labels):
+    return ['%s%s %s' % (name, _format_labels(labels), self.value)]
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join(('%s="%s"' % (k, _escape(v)) for k, v in labels)) + '}'
+
+def _get(name, kind, help, labels):
+  labels = tuple(sorted(labels.items()))
+  # Lookups of existing series don't take the registry lock
+  try:
+    return _metrics[name]['series'][labels]
+  except KeyError:
+    pass
+  with _lock:
+    metric = _metrics.setdefault(name, {'kind': kind, 'help': help, 'series': {}})
+    series = metric['series']
+    if labels not in series:
+      series[labels] = Histogram() if kind == 'histogram' else Counter()
+    return series[labels]
+
+def histogram(name, help, **labels):
+  return _get(name, 'histogram', help, labels)
+
+def counter(name, help, **labels):
+  return _get(name, 'counter', help, labels)
+
+def render():
+  with _lock:
+    metrics = [(name, m['kind'], m['help'], list(m['series'].items())) for name, m in sorted(_metrics.items())]
+  lines = []
+  for name, kind, help, series in metrics:
+    lines.append('# HELP %s %s' % (name, help))
+    lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in series:
+      lines.extend(value.render(name, labels))
+  return '\n'.join(lines) + '\n'
@@ -0,0 +1,70 @@
+import zlib
+import compression
+
+class PlainResponse(object):
+  def __init__(self, request):
+    self.request = request
+
+  def write(self, data):
+    self.request.wfile.write(data)
+
+  def finish(self):
+    pass
+
+class ChunkedResponse(object):
+  def __init__(self, request, encoding=None):
+    self.request = request
+    self.compressor = None
+    if encoding:
+      wbits = 31 if encoding == 'gzip' else 15
+      self.compressor = zlib.compressobj(compression.get_level(), zlib.DEFLATED, wbits)
+    self.finished = False
+
+  def _write_chunk(self, data):
+    if data:
+      self.request.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+
+  def write(self, data):
+    if self.compressor:
+      # Sync flushes keep streamed output moving instead of waiting for the compressor's buffer to fill
+      data = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self._write_chunk(data)
+
+  def finish(self):
+    if self.finished:
+      return
+    self.finished = True
+    if self.compressor:
+      self._write_chunk(self.compressor.flush())
+    self.request.wfile.write(b'0\r\n\r\n')
+
+def _can_chunk(request, code, headers):
+  if code < 200 or code in (204, 304) or request.command == 'HEAD':
+    return False
+  if compression.get_header(headers, 'Content-Length') or compression.get_header(headers, 'Transfer-Encoding'):
+    return False
+  return (getattr(request, 'request_version', None) == 'HTTP/1.1' and
+          getattr(request, 'protocol_version', None) == 'HTTP/1.1')
+
+def begin(request, code, headers):
+  response = compression.buffer_response(request, code, headers)
+  if response:
+    return response
+  headers = list(headers)
+  chunked = _can_chunk(request, code, headers)
+  encoding = None
+  if chunked:
+    headers.append(('Transfer-Encoding', 'chunked'))
+    if (not compression.get_header(headers, 'Content-Encoding') and
+        compression.is_compressible(compression.get_header(headers, 'Content-Type'))):
+      encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+      if encoding:
+        headers.append(('Content-Encoding', encoding))
+        headers = compression.add_vary(headers)
+  request.send_response(code)
+  for name, value in headers:
+    request.send_header(name, value)
+  request.end_headers()
+  if chunked:
+    return ChunkedResponse(request, encoding)
+  return PlainResponse(request)
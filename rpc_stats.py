@@ -0,0 +1,80 @@
+help_text = """
+rpc_stats.py prints the API calls extensions have made to a running Sessen server.
+
+It reads the /_sessen/metrics endpoint, so it must be run from a client allowed
+by metrics_allowed_clients. Calls are listed per extension and function with
+their count, errors, mean and p99 latency and the bytes sent each way.
+
+Usage:
+  rpc_stats.py [url]
+
+Here are some examples:
+  rpc_stats.py
+  rpc_stats.py https://localhost:9292/_sessen/metrics
+"""
+
+import re
+
+_SAMPLE = re.compile(r'^(sessen_rpc_\w+)\{(.*)\} (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def get_default_url():
+  import config
+  scheme = 'https' if config.get_bool('use_ssl', default=True) else 'http'
+  return '%s://localhost:%d/_sessen/metrics' % (scheme, config.get_int('port', default=9292))
+
+def fetch(url):
+  import ssl, urllib.request
+  # The server usually has a self-signed certificate
+  context = ssl.create_default_context()
+  context.check_hostname = False
+  context.verify_mode = ssl.CERT_NONE
+  with urllib.request.urlopen(url, context=context) as res:
+    return res.read().decode()
+
+def parse(text):
+  stats = {}
+  for line in text.splitlines():
+    m = _SAMPLE.match(line)
+    if not m:
+      continue
+    labels = dict(_LABEL.findall(m.group(2)))
+    key = (labels.get('extension', ''), labels.get('function', ''))
+    s = stats.setdefault(key, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'in': 0, 'out': 0, 'buckets': []})
+    value = float(m.group(3))
+    if line.startswith('sessen_rpc_calls_total'):
+      s['calls'] = int(value)
+    elif line.startswith('sessen_rpc_errors_total'):
+      s['errors'] = int(value)
+    elif line.startswith('sessen_rpc_seconds_sum'):
+      s['seconds'] = value
+    elif line.startswith('sessen_rpc_seconds_bucket'):
+      s['buckets'].append((float(labels['le']), value))
+    elif line.startswith('sessen_rpc_received_bytes_total'):
+      s['in'] = int(value)
+    elif line.startswith('sessen_rpc_sent_bytes_total'):
+      s['out'] = int(value)
+  return stats
+
+def percentile(buckets, count, p):
+  for bound, cumulative in buckets:
+    if cumulative >= count * p:
+      return bound
+  return float('inf')
+
+def main():
+  import sys
+  if len(sys.argv) > 1 and sys.argv[1] in ('?', 'help'):
+    print(help_text)
+    return
+  url = sys.argv[1] if len(sys.argv) > 1 else get_default_url()
+  stats = parse(fetch(url))
+  rows = sorted(stats.items(), key=lambda i: i[1]['calls'], reverse=True)
+  print('%-20s %-28s %10s %8s %10s %10s %12s %12s' % ('extension', 'function', 'calls', 'errors', 'mean ms', 'p99 ms', 'bytes in', 'bytes out'))
+  for (extension, function), s in rows:
+    mean = s['seconds'] / s['calls'] * 1000 if s['calls'] else 0.0
+    p99 = percentile(s['buckets'], s['calls'], 0.99) * 1000
+    print('%-20s %-28s %10d %8d %10.2f %10.1f %12d %12d' % (extension, function, s['calls'], s['errors'], mean, p99, s['in'], s['out']))
+
+if __name__ == '__main__':
+  main()
@@ -1,27 +1,47 @@
-import threading, queue, json, uuid, platform, sys, os
+import threading, queue, json, uuid, platform, sys, os, socket, itertools, asyncio
+import rpc_framing
 
 _results = {}
 _lock = threading.Lock()
+_streams = []
+_next_stream = itertools.count()
+
+class _Stream(object):
+  def __init__(self, client_pipe, server_pipe):
+    self.client_pipe = client_pipe
+    self.lock = threading.Lock()
+    self.protocol = rpc_framing.JsonLines()
+    if int(os.environ.get('SESSEN_PROTOCOL', 1)) >= rpc_framing.VERSION:
+      # The host understands framed messages so announce them before the first call
+      rpc_framing.write(client_pipe, [rpc_framing.handshake()])
+      self.protocol = rpc_framing.Frames()
+    in_thread = threading.Thread(target=_input_worker, args=(server_pipe,self.protocol), daemon=True)
+    in_thread.start()
 
 def _init():
-  global _client_pipe
   if not os.environ.get('SESSEN_SECRET'):
     # Only initialize the client if we're sandboxed
     return
 
+  socket_path = os.environ.get('SESSEN_SOCKET')
   pipes = os.environ.get('SESSEN_PIPE0'), os.environ.get('SESSEN_PIPE1')
+  if os.environ.get('SESSEN_STRICT_MODE') and platform.system() != 'Windows':
+    import preflight
+    preflight.PATH_EXCEPTIONS.extend(socket_path and [socket_path] or pipes)
   if platform.system() == 'Windows':
-    _client_pipe = sys.stdout
-    server_pipe = sys.stdin
+    _streams.append(_Stream(sys.stdout.buffer, sys.stdin.buffer))
+  elif socket_path:
+    # Calls may be spread over several streams so one large transfer doesn't hold up the rest
+    for _ in range(int(os.environ.get('SESSEN_SOCKET_STREAMS', 1))):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      sock.connect(socket_path)
+      stream = rpc_framing.SocketStream(sock)
+      _streams.append(_Stream(stream, stream))
   else:
     client_path, server_path = pipes
-    if os.environ.get('SESSEN_STRICT_MODE'):
-      import preflight
-      preflight.PATH_EXCEPTIONS.extend(pipes)
-    _client_pipe = open(client_path, 'w')
-    server_pipe = open(server_path, 'r')
-  in_thread = threading.Thread(target=_input_worker, args=(server_pipe,), daemon=True)
-  in_thread.start()
+    client_pipe = open(client_path, 'wb')
+    server_pipe = open(server_path, 'rb')
+    _streams.append(_Stream(client_pipe, server_pipe))
 
 def _parse_exception(exception):
   try:
@@ -32,24 +52,104 @@ def _parse_exception(exception):
   return Exception(exception)
 
 def _invoke(func, args, kwargs):
+  return _invoke_message({'func': func, 'args': args, 'kwargs': kwargs})
+
+def _send(message, res_q):
   id = str(uuid.uuid4())
-  res_q = queue.Queue()
-  i = {'func': func, 'args': args, 'kwargs': kwargs, 'id': id}
+  message['id'] = id
+  stream = _streams[next(_next_stream) % len(_streams)]
   try:
     with _lock:
       _results[id] = res_q
-      _client_pipe.write(json.dumps(i)+'\n')
-      _client_pipe.flush()
+    with stream.lock:
+      parts = stream.protocol.encode(message)
+      rpc_framing.write(stream.client_pipe, parts)
   except TypeError:
     breakpoint()
+
+def _invoke_message(message):
+  res_q = queue.Queue()
+  _send(message, res_q)
   r, ex = res_q.get()
   if ex:
     raise _parse_exception(ex)
   return r
 
-def _input_worker(server_pipe):
+def _invoke_many(calls):
+  # Sends (func, args, kwargs) tuples in one message and returns a (result, exception) pair for each
+  if not calls:
+    return []
+  calls = [{'func': func, 'args': args, 'kwargs': kwargs} for func, args, kwargs in calls]
+  results = _invoke_message({'batch': calls})
+  return [(r, _parse_exception(ex) if ex else None) for r, ex in results]
+
+class _FutureResult(object):
+  # Stands in for a result queue when the caller is awaiting on an event loop.
+  # The reader thread hands the result over to the loop instead of waking a
+  # blocked thread.
+  def __init__(self, loop):
+    self.loop = loop
+    self.future = loop.create_future()
+
+  def put(self, result):
+    # The caller may have given up and closed its loop before the reply came,
+    # the result is dropped then rather than raising in the reader thread
+    if self.loop.is_closed():
+      return
+    try:
+      self.loop.call_soon_threadsafe(self._resolve, result)
+    except RuntimeError:
+      pass
+
+  def _resolve(self, result):
+    # Done includes futures cancelled by a timeout
+    if self.future.done():
+      return
+    r, ex = result
+    if ex:
+      self.future.set_exception(_parse_exception(ex))
+    else:
+      self.future.set_result(r)
+
+async def _invoke_async(func, args, kwargs):
+  res = _FutureResult(asyncio.get_running_loop())
+  _send({'func': func, 'args': args, 'kwargs': kwargs}, res)
+  return await res.future
+
+async def _invoke_many_async(calls):
+  if not calls:
+    return []
+  res = _FutureResult(asyncio.get_running_loop())
+  _send({'batch': [{'func': func, 'args': args, 'kwargs': kwargs} for func, args, kwargs in calls]}, res)
+  results = await res.future
+  return [(r, _parse_exception(ex) if ex else None) for r, ex in results]
+
+class batch(object):
+  # Calls made on a batch are queued and sent together when the with block exits
+  def __init__(self):
+    self.calls = []
+    self.results = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.results = _invoke_many(self.calls)
+
+  def __getattr__(self, func):
+    if func[0] == '_':
+      raise AttributeError(func)
+    def queue_call(*args, **kwargs):
+      self.calls.append((func, args, kwargs))
+      return len(self.calls) - 1
+    return queue_call
+
+def _input_worker(server_pipe, protocol):
   while True:
-    rres = json.loads(server_pipe.readline())
+    rres = protocol.read(server_pipe)
+    if rres is None:
+      return
     with _lock:
       res_q = _results.pop(rres['id'])
     res_q.put((rres['result'], rres['exception']))
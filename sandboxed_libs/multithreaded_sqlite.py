@@ -1,39 +1,153 @@
-import sqlite3, time, threading, queue
+import sqlite3, time, threading, queue, urllib.parse
 
 class MultithreadedSqliteConnection(object):
-  def __init__(self, path, timeout=5*60):
+  # Writes run one at a time on a worker thread. Reads may run on the calling
+  # thread using a pool of read-only connections, which in WAL mode see the
+  # last commit without waiting on the writer.
+  #
+  # Writes submitted with run_batched are group committed. The worker applies
+  # every one that's queued in a single transaction, each in its own savepoint
+  # so a failing call doesn't undo the others, then commits once.
+  max_batch = 1000
+
+  def __init__(self, path, timeout=5*60, readers=0, synchronous=None, journal_mode=None, group_commit_delay=0):
     self.path = path
     self.timeout = timeout
+    self.group_commit_delay = group_commit_delay
+    self.synchronous = synchronous
+    self.journal_mode = journal_mode
+    # Every connection to an in-memory database gets its own database
+    self.reader_count = 0 if path == ':memory:' else readers
+    self.readers = queue.LifoQueue()
+    self.readers_created = 0
+    self.readers_lock = threading.Lock()
     self.queue = queue.Queue()
     self.thread = threading.Thread(target=self._worker, daemon=True)
     self.thread.start()
 
   def run(self, function):
+    return self._submit(function, False)
+
+  def run_batched(self, function):
+    # The function must not commit, roll back or begin a transaction itself
+    return self._submit(function, True)
+
+  def _submit(self, function, batched):
     result = queue.Queue()
-    self.queue.put((function, result))
+    self.queue.put((function, result, batched))
     result, exception = result.get()
     if exception:
       raise exception
     return result
 
+  def run_read(self, function):
+    # The function must not write, reader connections are opened read-only
+    if not self.reader_count:
+      return self.run(function)
+    connection = self._get_reader()
+    try:
+      return function(connection)
+    finally:
+      self.readers.put(connection)
+
+  def _get_reader(self):
+    try:
+      return self.readers.get_nowait()
+    except queue.Empty:
+      pass
+    with self.readers_lock:
+      create = self.readers_created < self.reader_count
+      if create:
+        self.readers_created += 1
+    if not create:
+      return self.readers.get()
+    try:
+      uri = 'file:' + urllib.parse.quote(self.path) + '?mode=ro'
+      connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+      connection.execute('PRAGMA temp_store = MEMORY')
+      return connection
+    except Exception:
+      with self.readers_lock:
+        self.readers_created -= 1
+      raise
+
+  def _connect(self):
+    connection = sqlite3.connect(self.path)
+    connection.execute('PRAGMA temp_store = MEMORY')
+    if self.journal_mode:
+      connection.execute('PRAGMA journal_mode = ' + self.journal_mode)
+    if self.synchronous:
+      connection.execute('PRAGMA synchronous = ' + self.synchronous)
+    return connection
+
+  def _next_batch(self, first):
+    # Collects queued batched calls, waiting up to group_commit_delay for more.
+    # Returns the batch and the unbatched call that ended it, if any.
+    batch = [first]
+    deadline = time.monotonic() + self.group_commit_delay
+    while len(batch) < self.max_batch:
+      try:
+        remaining = deadline - time.monotonic()
+        item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+      except queue.Empty:
+        break
+      if not item[2]:
+        return batch, item
+      batch.append(item)
+    return batch, None
+
+  def _run_batch(self, connection, batch):
+    results = []
+    try:
+      if connection.in_transaction:
+        connection.commit()
+      connection.execute('BEGIN IMMEDIATE')
+      for function, result, _ in batch:
+        connection.execute('SAVEPOINT batched_call')
+        try:
+          results.append((function(connection), None))
+        except Exception as ex:
+          connection.execute('ROLLBACK TO batched_call')
+          results.append((None, ex))
+        connection.execute('RELEASE batched_call')
+      connection.commit()
+    except Exception as ex:
+      if connection.in_transaction:
+        connection.rollback()
+      results = [(None, ex)] * len(batch)
+    for (function, result, _), r in zip(batch, results):
+      result.put(r)
+
   def _worker(self):
     connection = None
     pending_commit = False
+    item = None
     while True:
+      if item is None:
+        try:
+          item = self.queue.get(timeout=self.timeout)
+        except queue.Empty:
+          if connection and pending_commit:
+            connection.commit()
+            connection.execute('PRAGMA optimize')
+            pending_commit = False
+          continue
+      function, result, batched = item
+      item = None
+
       try:
-        function, result = self.queue.get(timeout=self.timeout)
-      except queue.Empty:
-        if connection and pending_commit:
-          connection.commit()
-          connection.execute('PRAGMA optimize')
-          pending_commit = False
+        if not connection:
+          connection = self._connect()
+      except Exception as ex:
+        result.put((None, ex))
         continue
+      pending_commit = True
 
-      if not connection:
-        connection = sqlite3.connect(self.path)
-        connection.execute('PRAGMA temp_store = MEMORY')
+      if batched:
+        batch, item = self._next_batch((function, result, batched))
+        self._run_batch(connection, batch)
+        continue
 
-      pending_commit = True
       res, exception = None, None
       try:
         res = function(connection)
@@ -42,5 +156,5 @@ class MultithreadedSqliteConnection(object):
 
       result.put((res, exception))
 
-def connect(path, timeout=5*60):
-  return MultithreadedSqliteConnection(path, timeout)
+def connect(path, timeout=5*60, readers=0, synchronous=None, journal_mode=None, group_commit_delay=0):
+  return MultithreadedSqliteConnection(path, timeout, readers, synchronous, journal_mode, group_commit_delay)
@@ -0,0 +1,323 @@
+import os, json, struct, binascii, socket, array, collections
+
+MAGIC = b'SSN'
+VERSION = 2
+MAX_LENGTH = 1073741824
+
+_FRAME_HEADER = struct.Struct('>II')
+_BLOB_LENGTH = struct.Struct('>Q')
+
+class FrameError(ValueError):
+  # Raised once a malformed message has been read in full, so the next one
+  # starts where it should. id is None when the sender can't be answered.
+  def __init__(self, reason, id=None):
+    ValueError.__init__(self, reason)
+    self.id = id
+
+def _message_id(message):
+  return message.get('id') if type(message) is dict else None
+
+def _discard(pipe, length):
+  while length > 0:
+    chunk = pipe.read(min(length, 1024**2))
+    if not chunk:
+      return
+    length -= len(chunk)
+
+class FileDescriptor(int):
+  # An open descriptor to hand to the other side. It's closed once it's been sent.
+  pass
+
+class Fds(list):
+  # Descriptors to attach to the next write on a socket stream
+  pass
+
+def to_json(obj, blobs=None, fds=None):
+  # Bytes are moved out of band when blobs is a list, otherwise they're base64 encoded.
+  # A dict whose only key starts with $ is wrapped in {'$$': ...} so it can't be
+  # mistaken for one of these.
+  t = type(obj)
+  if t is FileDescriptor:
+    if fds is None:
+      os.close(obj)
+      raise TypeError("File descriptors can't be sent over this transport")
+    fds.append(obj)
+    return {'$fd': len(fds)-1}
+  if t is bytes or t is bytearray or t is memoryview:
+    if blobs is None:
+      return {'$b64': binascii.b2a_base64(obj, newline=False).decode()}
+    blobs.append(obj)
+    return {'$b': len(blobs)-1}
+  if t is dict:
+    d = {k: to_json(v, blobs, fds) for k, v in obj.items()}
+    if len(d) == 1 and type(next(iter(d))) is str and next(iter(d))[:1] == '$':
+      return {'$$': d}
+    return d
+  if t is list or t is tuple:
+    return [to_json(i, blobs, fds) for i in obj]
+  return obj
+
+def from_json(obj, blobs=None, fds=None):
+  t = type(obj)
+  if t is dict:
+    if len(obj) == 1:
+      key, value = next(iter(obj.items()))
+      if key == '$$' and type(value) is dict:
+        return {k: from_json(v, blobs, fds) for k, v in value.items()}
+      if key == '$b':
+        if blobs is None or type(value) is not int or not 0 <= value < len(blobs):
+          raise ValueError('Invalid RPC blob reference')
+        return blobs[value]
+      if key == '$fd':
+        if not fds:
+          raise ValueError('Invalid RPC file descriptor reference')
+        # Descriptors arrive in the order they were referenced
+        return fds.popleft()
+      if key == '$b64':
+        return binascii.a2b_base64(value)
+    return {k: from_json(v, blobs, fds) for k, v in obj.items()}
+  if t is list:
+    return [from_json(i, blobs, fds) for i in obj]
+  return obj
+
+class JsonLines(object):
+  # Version 1: one JSON document per line. A trailing bytes argument or a bytes
+  # result is sent raw after the line, any other bytes are base64 encoded.
+  version = 1
+
+  def __init__(self, prefix=b''):
+    self.prefix = prefix
+    self.read_size = 0
+    self.encoded_size = 0
+
+  def encode(self, message):
+    blob = None
+    message = dict(message)
+    args = message.get('args')
+    if args and type(args[-1]) is bytes:
+      blob = args[-1]
+      message['args'] = args[:-1]
+    elif type(message.get('result')) is bytes:
+      blob = message['result']
+      message['result'] = None
+    message = to_json(message)
+    if blob is not None:
+      message['blob'] = len(blob)
+    parts = [(json.dumps(message)+'\n').encode()]
+    if blob is not None:
+      parts.append(blob)
+    self.encoded_size = size(parts)
+    return parts
+
+  def read(self, pipe):
+    line = self.prefix + pipe.readline(MAX_LENGTH)
+    self.prefix = b''
+    if not line:
+      return None
+    try:
+      message = json.loads(line)
+    except ValueError:
+      # Whether a blob follows is unknown so the stream can't be resynced
+      raise FrameError('Invalid RPC message')
+    self.read_size = len(line)
+    blob = None
+    if type(message) is dict and 'blob' in message:
+      blob = pipe.read(message.pop('blob'))
+      self.read_size += len(blob)
+    try:
+      message = from_json(message)
+    except (ValueError, TypeError) as ex:
+      raise FrameError(str(ex), _message_id(message))
+    if blob is not None:
+      if 'args' in message:
+        message['args'].append(blob)
+      else:
+        message['result'] = blob
+    return message
+
+class Frames(object):
+  # Version 2: a header giving the JSON length and blob count, the blob lengths,
+  # the JSON document and then each blob. Bytes anywhere in a message travel raw.
+  version = VERSION
+
+  def __init__(self, send_fds=False):
+    self.send_fds = send_fds
+    self.read_size = 0
+    self.encoded_size = 0
+
+  def encode(self, message):
+    blobs = []
+    fds = [] if self.send_fds else None
+    data = json.dumps(to_json(message, blobs, fds)).encode()
+    parts = [Fds(fds)] if fds else []
+    parts.append(_FRAME_HEADER.pack(len(data), len(blobs)))
+    parts.extend((_BLOB_LENGTH.pack(len(i)) for i in blobs))
+    parts.append(data)
+    parts.extend(blobs)
+    self.encoded_size = size(parts)
+    return parts
+
+  def read(self, pipe):
+    header = pipe.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+      return None
+    length, blob_count = _FRAME_HEADER.unpack(header)
+    if blob_count*_BLOB_LENGTH.size > MAX_LENGTH:
+      raise FrameError('RPC frame too large')
+    lengths = [_BLOB_LENGTH.unpack(pipe.read(_BLOB_LENGTH.size))[0] for _ in range(blob_count)]
+    # The whole frame is always consumed before an error is raised so the
+    # stream stays in sync
+    data = pipe.read(length) if length <= MAX_LENGTH else _discard(pipe, length)
+    try:
+      message = json.loads(data) if data is not None else None
+    except ValueError:
+      message = None
+    if data is None or length + sum(lengths) > MAX_LENGTH:
+      for i in lengths:
+        _discard(pipe, i)
+      raise FrameError('RPC frame too large', _message_id(message))
+    if message is None:
+      for i in lengths:
+        _discard(pipe, i)
+      raise FrameError('Invalid RPC message')
+    blobs = [pipe.read(i) for i in lengths]
+    try:
+      message = from_json(message, blobs, getattr(pipe, 'received_fds', None))
+    except (ValueError, TypeError) as ex:
+      raise FrameError(str(ex), _message_id(message))
+    self.read_size = _FRAME_HEADER.size + _BLOB_LENGTH.size*blob_count + length + sum(lengths)
+    return message
+
+def size(parts):
+  return sum((len(part) for part in parts if type(part) is not Fds))
+
+def handshake():
+  return MAGIC + bytes((VERSION,))
+
+def accept(pipe):
+  # Clients that don't send the handshake are answered with JSON lines
+  first = pipe.read(1)
+  if first == MAGIC[:1]:
+    rest = pipe.read(len(MAGIC))
+    if rest[:-1] == MAGIC[1:] and rest[-1:] == bytes((VERSION,)):
+      return Frames(isinstance(pipe, SocketStream))
+    raise ValueError('Unsupported RPC protocol')
+  return JsonLines(first)
+
+def write(pipe, parts):
+  for part in parts:
+    pipe.write(part)
+  pipe.flush()
+
+class SocketStream(object):
+  # A file-like wrapper over a Unix domain socket that can carry descriptors
+  # with SCM_RIGHTS. Reads always go through recvmsg so descriptors attached
+  # to the data aren't dropped.
+  #
+  # Data is received into one buffer that's reused between reads and consumed
+  # by moving an offset, so each read costs a single copy out of it. The
+  # buffer grows to fit the largest read and is only kept up to RETAIN_SIZE.
+  MAX_FDS = 16
+  RECV_SIZE = 65536
+  RETAIN_SIZE = 16*1024**2
+
+  def __init__(self, sock, accept_fds=True):
+    self.sock = sock
+    self.accept_fds = accept_fds
+    self.buffer = bytearray(self.RECV_SIZE)
+    self.start = 0
+    self.end = 0
+    self.received_fds = collections.deque()
+    self.pending = []
+    self.pending_fds = []
+
+  def _fill(self, size):
+    # Receives once, making room for at least size bytes past the read offset
+    if self.start == self.end:
+      self.start = self.end = 0
+      if len(self.buffer) > max(size, self.RETAIN_SIZE):
+        self.buffer = bytearray(max(size, self.RECV_SIZE))
+    if self.start + size > len(self.buffer):
+      if self.start:
+        self.buffer[:self.end-self.start] = self.buffer[self.start:self.end]
+        self.end -= self.start
+        self.start = 0
+      if size > len(self.buffer):
+        self.buffer.extend(bytes(max(size, 2*len(self.buffer)) - len(self.buffer)))
+    with memoryview(self.buffer) as view:
+      nbytes, ancdata, flags, address = self.sock.recvmsg_into([view[self.end:]], socket.CMSG_SPACE(self.MAX_FDS*4))
+    for level, kind, payload in ancdata:
+      if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+        fds = array.array('i')
+        fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+        for fd in fds:
+          if self.accept_fds:
+            self.received_fds.append(fd)
+          else:
+            os.close(fd)
+    self.end += nbytes
+    return nbytes > 0
+
+  def _take(self, end):
+    with memoryview(self.buffer) as view:
+      data = bytes(view[self.start:end])
+    self.start = end
+    return data
+
+  def read(self, length):
+    while self.end - self.start < length and self._fill(length):
+      pass
+    return self._take(min(self.end, self.start + length))
+
+  def readline(self, limit=-1):
+    searched = 0
+    while True:
+      end = self.buffer.find(b'\n', self.start + searched, self.end)
+      if end >= 0:
+        end += 1
+        break
+      if limit >= 0 and self.end - self.start >= limit:
+        end = self.start + limit
+        break
+      searched = self.end - self.start
+      if not self._fill(searched + 1):
+        end = self.end
+        break
+    if limit >= 0:
+      end = min(end, self.start + limit)
+    return self._take(end)
+
+  def write(self, part):
+    if type(part) is Fds:
+      self.pending_fds.extend(part)
+    else:
+      self.pending.append(part)
+
+  def flush(self):
+    # Small parts are joined so a frame usually goes out in a single send
+    chunks, small = [], []
+    for part in self.pending:
+      if len(part) < self.RECV_SIZE:
+        small.append(part)
+        continue
+      if small:
+        chunks.append(b''.join(small))
+        small = []
+      chunks.append(part)
+    if small:
+      chunks.append(b''.join(small))
+    fds = self.pending_fds
+    self.pending, self.pending_fds = [], []
+    if fds:
+      try:
+        first = memoryview(chunks.pop(0)) if chunks else memoryview(b'')
+        sent = self.sock.sendmsg([first[:1]], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))])
+        self.sock.sendall(first[sent:])
+      finally:
+        for fd in fds:
+          os.close(fd)
+    for chunk in chunks:
+      self.sock.sendall(chunk)
+
+  def close(self):
+    self.sock.close()
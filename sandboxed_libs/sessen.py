@@ -1,4 +1,4 @@
-import sys, os, json, uuid, threading, queue, inspect, re, binascii, pickle, mimetypes, time, urllib.parse, types, atexit, logging, wsgiref.handlers, importlib.util
+import sys, os, json, uuid, threading, queue, inspect, re, binascii, pickle, mimetypes, time, urllib.parse, types, atexit, logging, wsgiref.handlers, importlib.util, collections
 import api_client
 
 _cached_name = os.environ.get('SESSEN_NAME')
@@ -11,7 +11,36 @@ if is_sandboxed:
   if os.environ.get('SESSEN_STRICT_MODE'):
     mimetypes.guess_type('') # Prepopulate the cached type database since we won't be able to access it once the sandbox is locked
 else:
-  import api_backend as api
+  import api_backend
+
+  class _InstrumentedApi(object):
+    # Records the same per-function metrics for hosted extensions as the broker
+    # does for sandboxed ones. Private names pass straight through so helpers
+    # that reach into the backend keep working.
+    def __getattr__(self, name):
+      value = getattr(api_backend, name)
+      if name[0] == '_' or not callable(value):
+        return value
+      def call(*args, **kwargs):
+        start = time.perf_counter()
+        error = False
+        result = None
+        try:
+          result = value(*args, **kwargs)
+          return result
+        except Exception:
+          error = True
+          raise
+        finally:
+          bytes_in = sum((len(i) for i in args if type(i) is bytes))
+          bytes_out = len(result) if type(result) is bytes else 0
+          api_backend._rpc_record(get_name(), name, time.perf_counter()-start, error, bytes_in, bytes_out)
+      return call
+
+    def __setattr__(self, name, value):
+      setattr(api_backend, name, value)
+
+  api = _InstrumentedApi()
   _old_thread_start = threading.Thread.start
   def _thread_start_shim(self, *args, **kwargs):
     ct = threading.current_thread()
@@ -97,7 +126,7 @@ class File(object):
           return buf
         buf += r
 
-    data = a2b(api.file_read(self.handle, length))
+    data = api.file_read(self.handle, length)
     if hasattr(self, 'encoding'):
       data = data.decode(self.encoding)
     return data
@@ -122,12 +151,19 @@ class File(object):
 def open(path, mode, encoding=None):
   return File(path, mode, encoding)
 
+def open_fd(path, mode='rb', encoding=None):
+  # Opens the file through a descriptor passed from the host so I/O doesn't go
+  # through the API. This needs the socket transport when sandboxed.
+  fd = api.file_open_fd(_get_secret(), path, mode)
+  return os.fdopen(int(fd), mode, encoding=encoding)
+
 def get_file(path):
   with open(path, 'rb') as f:
     return f.read()
 
 def write_file(path, data, mode='wb'):
-  api.file_write(_get_secret(), path, mode, b2a(data))
+  with open(path, mode) as f:
+    f.write(data)
 
 def listdir(path):
   return api.file_list(_get_secret(), path)
@@ -175,51 +211,69 @@ def import_from_path_via_broker(path, name=None):
 path = import_from_path(sys.modules[os.path.getmtime.__module__].__file__, 'sessen_path_shim')
 path.os = sys.modules[__name__]
 
-def bind_on_own_thread(method, route, callback=None):
+default_bind_slots = 8
+
+def bind_on_own_thread(method, route, callback=None, slots=None):
   global _should_wait_for_exit_event
   _should_wait_for_exit_event = True
   if callback:
     secret = _get_secret()
+    if slots is None:
+      slots = default_bind_slots
     def listener(secret, method, route, callback):
       while True:
-        d = api.connection_get(secret, method, route)
-        t = threading.Thread(target=callback, args=(Connection(d),), daemon=True)
-        t.start()
+        for d in api.connection_get_many(secret, method, route, slots):
+          _start_handler(callback, d)
     t = threading.Thread(target=listener, args=(secret, method, route, callback), daemon=True)
     t.start()
   else:
     def decorator(func):
-      bind_on_own_thread(method, route, func)
+      bind_on_own_thread(method, route, func, slots)
       return func
     return decorator
 
 
+def _start_handler(callback, d):
+  # Coroutine handlers share the aio event loop instead of getting a thread each
+  if inspect.iscoroutinefunction(callback):
+    aio._start_handler(callback, d)
+  else:
+    t = threading.Thread(target=callback, args=(Connection(d),), daemon=True)
+    t.start()
+
 _bind_lock = threading.Lock()
 _bind_routes = {}
-def bind(method, route, callback=None):
+_bind_slots = {}
+def bind(method, route, callback=None, slots=None):
   global _should_wait_for_exit_event
   _should_wait_for_exit_event = True
   if callback:
     secret = _get_secret()
     with _bind_lock:
+      _bind_slots[secret] = max(_bind_slots.get(secret, 1), slots or default_bind_slots)
       if secret not in _bind_routes:
         _bind_routes[secret] = []
         def route_connections(secret):
           while True:
-            d = api.connection_get(secret, '.*', '.*')
-            for r in _bind_routes[secret]:
-              if re.match(r['route'], d['path']) and re.match(r['method'], d['method']):
-                d['method_regex'] = r['method']
-                d['route_regex'] = r['route']
-                t = threading.Thread(target=r['callback'], args=(Connection(d),), daemon=True)
-                t.start()
-                break
+            for d in api.connection_get_many(secret, '.*', '.*', _bind_slots[secret]):
+              for r in _bind_routes[secret]:
+                if re.match(r['route'], d['path']) and re.match(r['method'], d['method']):
+                  d['method_regex'] = r['method']
+                  d['route_regex'] = r['route']
+                  _start_handler(r['callback'], d)
+                  break
+              else:
+                # Respond so the slot is released instead of leaving the client hanging
+                connection = Connection(d)
+                connection.set_response_code(404)
+                connection.write('Not Found!')
+                connection.close()
         t = threading.Thread(target=route_connections, args=(secret,), daemon=True)
         t.start()
     _bind_routes[secret].append({'method': method, 'route': route, 'callback': callback})
   else:
     def decorator(func):
-      bind(method, route, func)
+      bind(method, route, func, slots)
       return func
     return decorator
 
@@ -235,12 +289,17 @@ def _parse_headers(h):
   return headers
 
 class Connection(object):
+  write_buffer_size = 64*1024
+
   def __init__(self, d):
     self.__dict__.update(d)
     self.request_headers = _parse_headers(self.headers)
     self._parse_cookies()
     self.client_address = tuple(self.client_address)
     self.response_started = False
+    self.closed = False
+    self._write_buffer = []
+    self._write_buffered = 0
     self.response_code = 200
     self.headers = []
     self.args = re.match(self.route_regex, self.path).groupdict()
@@ -258,22 +317,32 @@ class Connection(object):
       pass
 
   def __del__(self):
-    api.connection_close(self.handle)
+    self.close()
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      try:
+        # A handler that never wrote anything gets no implicit response
+        if self._write_buffer:
+          self.flush()
+      finally:
+        api.connection_close(self.handle, self.route_regex)
 
   def read(self, length):
-    return a2b(api.connection_read(self.handle, length))
+    return api.connection_read(self.handle, length)
 
   def receive_json(self):
     cl = int(self.request_headers['Content-Length'][0])
-    buf = b''
+    chunks = []
     remaining = cl
     while remaining > 0:
-      b = self.read(min(4096, remaining))
+      b = self.read(min(1024**2, remaining))
       if not b:
         break
-      buf += b
+      chunks.append(b)
       remaining -= len(b)
-    return json.loads(buf.decode())
+    return json.loads(b''.join(chunks).decode())
 
   def set_response_code(self, code):
     self.response_code = code
@@ -318,17 +387,37 @@ class Connection(object):
       self.response_started = True
 
   def write(self, data, encoding='utf-8'):
-    self._ensure_response_started()
     if type(data) is str:
       data = data.encode(encoding)
-    api.connection_write(self.handle, b2a(data))
+    # Small writes are coalesced and sent together once the buffer fills or on flush
+    self._write_buffer.append(data)
+    self._write_buffered += len(data)
+    if self._write_buffered >= self.write_buffer_size:
+      self.flush()
 
-  def send_text(self, text, content_type='text/plain'):
+  def flush(self):
+    self._ensure_response_started()
+    if self._write_buffer:
+      data = b''.join(self._write_buffer)
+      self._write_buffer = []
+      self._write_buffered = 0
+      api.connection_write(self.handle, data)
+
+  def send_text(self, text, content_type='text/plain', encoding='utf-8'):
+    if type(text) is str:
+      text = text.encode(encoding)
     self.set_response_code(200)
     self.add_header('Content-Type', content_type)
     self.add_header('Content-Length', len(text))
     self.write(text)
 
+  def send_stream(self, chunks, content_type='text/plain', encoding='utf-8'):
+    # Without a Content-Length the host streams the response with chunked transfer encoding
+    self.add_header('Content-Type', content_type)
+    for chunk in chunks:
+      self.write(chunk, encoding)
+    self.flush()
+
   def send_html(self, html):
     self.send_text(html, content_type='text/html')
 
@@ -337,28 +426,69 @@ class Connection(object):
     self.send_text(j, content_type='application/json')
 
 def serve_static_content(path='static'):
-  secret = _get_secret()
-  route = ('/'+path+'/(?P<path>.+)').replace('//','/')
+  route = ('/'+path+'/').replace('//','/')
   static_root = path[1:] if path[0] == os.path.sep else path
-  _cache = {}
-  def callback(connection):
-    path = connection.args['path']
-    full_path = os.path.join(static_root, path)
+  # Files are served by the host directly, without a round trip to the extension
+  api.static_mount(_get_secret(), route, static_root)
+
+def _invoke_many(calls):
+  # Sandboxed calls go to the host in one message, hosted ones just run in order
+  if is_sandboxed:
+    return api_client._invoke_many(calls)
+  results = []
+  for func, args, kwargs in calls:
     try:
+      results.append((getattr(api, func)(*args, **kwargs), None))
+    except Exception as ex:
+      results.append((None, ex))
+  return results
+
+class _DatastoreCache(object):
+  # An LRU cache of decoded datastore values, missing keys included. The host
+  # sends invalidations whenever a path the extension can read is written.
+  # Every invalidation bumps the generation so a read that was in flight at
+  # the time isn't cached.
+  def __init__(self, max_entries):
+    self.max_entries = max_entries
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    self.generation = 0
+
+  def get(self, path):
+    # Returns a (hit, value) pair
+    with self.lock:
       try:
-        data = _cache[path]
+        value = self.entries[path]
       except KeyError:
-        data = get_file(full_path)
-        _cache[path] = data
-      ctype = mimetypes.guess_type(path)[0]
-      connection.send_text(data, ctype=ctype)
-    except (FileNotFoundError, PermissionError):
-      connection.set_response_code(400)
-      connection.write('Not Found!')
-  bind('GET', route, callback)
+        return False, None
+      self.entries.move_to_end(path)
+      return True, value
+
+  def put(self, path, value, generation):
+    with self.lock:
+      if generation != self.generation:
+        return
+      self.entries[path] = value
+      self.entries.move_to_end(path)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def invalidate(self, path, prefix=False):
+    with self.lock:
+      self.generation += 1
+      if path is None:
+        self.entries.clear()
+      elif prefix:
+        for key in [key for key in self.entries if key.startswith(path)]:
+          del self.entries[key]
+      else:
+        self.entries.pop(path, None)
+
+_MISSING = object()
 
 class _Datastore(object):
   sep = '/'
+  _cache = None
 
   def join_path(self, *paths):
     path = self.sep.join(paths)
@@ -371,42 +501,160 @@ class _Datastore(object):
 
   def shared_path(self, path):
     return self.join_path('shared', path)
-  
+
+  def enable_cache(self, max_entries=1000):
+    # Values returned from the cache are shared between callers so they
+    # shouldn't be modified. Only writes made through the host invalidate
+    # them, so don't cache paths that are changed with ds.py or by another
+    # process while the server runs. Hosted extensions share this object and don't
+    # read over a pipe, so only sandboxed ones cache.
+    if not is_sandboxed or self._cache:
+      return
+    api.datastore_cache_enable(_get_secret())
+    cache = _DatastoreCache(max_entries)
+    threading.Thread(target=self._cache_invalidation_worker, args=(cache,), daemon=True).start()
+    self._cache = cache
+
+  def _cache_invalidation_worker(self, cache):
+    try:
+      while True:
+        for invalidation in api.datastore_invalidations(_get_secret()):
+          if invalidation is None:
+            cache.invalidate(None)
+          else:
+            cache.invalidate(*invalidation)
+    finally:
+      # Without invalidations the cache can't be trusted
+      self._cache = None
+
+  def _invalidate(self, path, prefix=False):
+    # Writes are dropped from the cache as soon as they return so they're read
+    # back, the host's invalidation follows later
+    cache = self._cache
+    if cache:
+      cache.invalidate(path, prefix)
+
+  def _get_cached(self, path):
+    cache = self._cache
+    if not cache:
+      return pickle.loads(api.datastore_get(_get_secret(), path))
+    hit, value = cache.get(path)
+    if not hit:
+      generation = cache.generation
+      try:
+        value = pickle.loads(api.datastore_get(_get_secret(), path))
+      except KeyError:
+        value = _MISSING
+      cache.put(path, value, generation)
+    if value is _MISSING:
+      raise KeyError(path)
+    return value
+
   def __getitem__(self, path):
-    return pickle.loads(a2b(api.datastore_get(_get_secret(), path)))
+    return self._get_cached(path)
 
   def get_raw(self, path):
-    return a2b(api.datastore_get(_get_secret(), path))
+    return api.datastore_get(_get_secret(), path)
 
   def __setitem__(self, path, value):
-    api.datastore_set(_get_secret(), path, b2a(pickle.dumps(value)))
+    self.set_raw(path, pickle.dumps(value))
 
   def set_raw(self, path, value):
-    api.datastore_set(_get_secret(), path, b2a(value))
+    try:
+      api.datastore_set(_get_secret(), path, value)
+    finally:
+      self._invalidate(path)
 
   def __delitem__(self, path):
-    api.datastore_delete(_get_secret(), path)
+    try:
+      api.datastore_delete(_get_secret(), path)
+    finally:
+      self._invalidate(path)
 
-  def keys(self, path):
-    page = 0
+  def keys(self, path, page_size=None):
+    cursor = None
     while True:
-      k = api.datastore_keys(_get_secret(), path, page)
-      for i in k:
+      page = api.datastore_keys_page(_get_secret(), path, cursor, page_size)
+      for i in page['keys']:
         yield i
-      if len(k) < 1:
+      cursor = page['cursor']
+      if cursor is None:
         return
-      page += 1
 
   def test_and_set(self, path, value):
-    return pickle.loads(a2b(api.datastore_test_and_set(_get_secret(),
-                                                       path,
-                                                       b2a(pickle.dumps(value)))))
+    try:
+      return pickle.loads(api.datastore_test_and_set(_get_secret(),
+                                                     path,
+                                                     pickle.dumps(value)))
+    finally:
+      self._invalidate(path)
   def get(self, path):
     try:
       return self[path]
     except KeyError:
       return None
 
+  def get_many(self, paths, default=None):
+    paths = list(paths)
+    cache = self._cache
+    if not cache:
+      values = api.datastore_get_many(_get_secret(), paths)
+      return [default if r is None else pickle.loads(r) for r in values]
+    values = {}
+    for path in paths:
+      hit, value = cache.get(path)
+      if hit:
+        values[path] = value
+    misses = [path for path in dict.fromkeys(paths) if path not in values]
+    if misses:
+      generation = cache.generation
+      for path, r in zip(misses, api.datastore_get_many(_get_secret(), misses)):
+        values[path] = _MISSING if r is None else pickle.loads(r)
+        cache.put(path, values[path], generation)
+    return [default if values[path] is _MISSING else values[path] for path in paths]
+
+  def set_many(self, items):
+    if hasattr(items, 'items'):
+      items = items.items()
+    items = [[path, pickle.dumps(value)] for path, value in items]
+    try:
+      api.datastore_set_many(_get_secret(), items)
+    finally:
+      for path, value in items:
+        self._invalidate(path)
+
+  def delete_many(self, paths):
+    paths = list(paths)
+    secret = _get_secret()
+    try:
+      results = _invoke_many([('datastore_delete', (secret, path), {}) for path in paths])
+    finally:
+      for path in paths:
+        self._invalidate(path)
+    for r, ex in results:
+      if ex and not isinstance(ex, KeyError):
+        raise ex
+
+  def delete_prefix(self, path):
+    # Deletes every key starting with path and returns how many were deleted
+    try:
+      return api.datastore_delete_prefix(_get_secret(), path)
+    finally:
+      self._invalidate(path, True)
+
+  def watch(self, path, since_version=None, timeout=None):
+    # Waits until keys starting with path change after since_version and
+    # returns {'version': v, 'keys': [...]}, pass the version to the next call.
+    # Keys is empty on timeout and None if the changes are no longer known.
+    # Without since_version the current version is returned right away.
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      remaining = None if deadline is None else max(0, deadline - time.time())
+      result = api.datastore_watch(_get_secret(), path, since_version, remaining)
+      if since_version is None or result['keys'] != [] or (deadline is not None and time.time() >= deadline):
+        return result
+      since_version = result['version']
+
 datastore = _Datastore()
 
 # TODO: avoid creating user paths until something is set
@@ -425,17 +673,13 @@ class PersistentDatastore(object):
       return connection
 
   def cleanup(self):
-    users_to_delete = []
     target_depth = self.path.count('/') + 1
-    for key in datastore.keys(self.path):
-      if key.count('/') == target_depth and key.endswith('/last_access'):
-        last_access = datastore[key]
-        if time.time() - last_access > self.expires:
-          id = key[len(self.path):-12]
-          users_to_delete.append(id)
-    for id in users_to_delete:
-      for key in datastore.keys(datastore.join_path(self.path, id)+'/'):
-        del datastore[key]
+    last_access_keys = [key for key in datastore.keys(self.path)
+                        if key.count('/') == target_depth and key.endswith('/last_access')]
+    for key, last_access in zip(last_access_keys, datastore.get_many(last_access_keys)):
+      if last_access is not None and time.time() - last_access > self.expires:
+        id = key[len(self.path):-12]
+        datastore.delete_prefix(datastore.join_path(self.path, id)+'/')
     self.last_cleanup = time.time()
 
   def maybe_cleanup(self):
@@ -466,12 +710,7 @@ class PersistentDatastore(object):
 
   def delete_all(self, connection):
     id = self.get_id(connection)
-    path = datastore.join_path(self.path, id) + '/'
-    for key in datastore.keys(path):
-      try:
-        del datastore[key]
-      except KeyError:
-        pass
+    datastore.delete_prefix(datastore.join_path(self.path, id) + '/')
 
 class SessionDatastore(PersistentDatastore):
   def __init__(self, path = 'session', expires = (3*24*60*60), cleanup_frequency = (15*60)):
@@ -490,17 +729,26 @@ class datastore_lock(object):
 
   def __enter__(self):
     oldest = time.time()
-    sleep_duration = 0.001
     while True:
       try:
         old = datastore.test_and_set(self.path, {'last_set':time.time()})
-        oldest = min(oldest, old['last_set'])
-        if self.timeout and (time.time()-oldest) > self.timeout:
-          break
       except KeyError:
-        break
-      time.sleep(sleep_duration)
-      sleep_duration *= 2
+        return
+      oldest = min(oldest, old['last_set'])
+      # Wait for the holder to delete the lock. Waiters only read it here so
+      # they don't wake each other up.
+      version = datastore.watch(self.path)['version']
+      while True:
+        try:
+          datastore.get_raw(self.path)
+        except KeyError:
+          break
+        remaining = None
+        if self.timeout:
+          remaining = self.timeout - (time.time()-oldest)
+          if remaining <= 0:
+            return
+        version = datastore.watch(self.path, version, remaining)['version']
 
   def __exit__(self, *e):
     del datastore[self.path]
@@ -527,13 +775,34 @@ class ExtensionDatastore(object):
   def __delitem__(self, path):
     del datastore[self.join_path(path)]
 
-  def keys(self, path):
+  def keys(self, path, page_size=None):
     old_path_len = len(self.path + datastore.sep)
-    for key in datastore.keys(self.join_path(path)):
+    for key in datastore.keys(self.join_path(path), page_size):
       yield key[old_path_len:]
 
   def test_and_set(self, path, value):
     return datastore.test_and_set(self.join_path(path), value)
+
+  def get_many(self, paths, default=None):
+    return datastore.get_many([self.join_path(path) for path in paths], default)
+
+  def set_many(self, items):
+    if hasattr(items, 'items'):
+      items = items.items()
+    datastore.set_many([(self.join_path(path), value) for path, value in items])
+
+  def delete_many(self, paths):
+    datastore.delete_many([self.join_path(path) for path in paths])
+
+  def delete_prefix(self, path):
+    return datastore.delete_prefix(self.join_path(path))
+
+  def watch(self, path, since_version=None, timeout=None):
+    result = datastore.watch(self.join_path(path), since_version, timeout)
+    if result['keys']:
+      old_path_len = len(self.path + datastore.sep)
+      result['keys'] = [key[old_path_len:] for key in result['keys']]
+    return result
   
   def lock(self, path, timeout=None):
     return datastore_lock(self.join_path(path), timeout)
@@ -545,11 +814,10 @@ class webrequest(object):
     if headers is None:
       headers = {}
       headers['User-Agent'] = USER_AGENT
-    if data is not None:
-      data = b2a(data)
-    d = api.webrequest(_get_secret(), method, url, headers, data, ssl_verify, timeout)
+    self._load(api.webrequest(_get_secret(), method, url, headers, data, ssl_verify, timeout))
+
+  def _load(self, d):
     self.__dict__.update(d)
-    self.data = a2b(self.data)
     try:
       self.headers = _parse_headers(self.info)
     except AttributeError:
@@ -706,7 +974,8 @@ def _postmaster_function_call_handler(message):
 def _postmaster_function_result_handler(message):
   try:
     result = _shared_function_results[message['id']]
-    result.put((message['result'], message['exception']))
+    # Replies to has_function and list_functions don't carry an exception
+    result.put((message['result'], message.get('exception')))
     return True
   except KeyError:
     return False
@@ -808,3 +1077,5 @@ class ExtensionProxy(object):
 
 def get_neighbors(timeout=None):
   return [ExtensionProxy(name, timeout=timeout) for name in api.messages_list_recipients(_get_secret())]
+
+import sessen_aio as aio
@@ -0,0 +1,345 @@
+import sys, json, pickle, asyncio, threading, functools
+import api_client, sessen
+
+# Awaitable versions of the extension API. Sandboxed calls are resolved by
+# api_client's reader thread directly on the event loop so waiting on the host
+# doesn't tie up a thread. Hosted extensions call the backend directly so
+# their calls run in the loop's executor instead.
+#
+# Handlers bound with an async def callback run on a loop shared by the whole
+# extension. Since they don't need a thread each, bind them with enough slots
+# for the connections they're expected to hold open.
+
+_loops = {}
+_loops_lock = threading.Lock()
+
+def get_loop():
+  # Hosted extensions share a process so each gets its own loop thread, which
+  # keeps get_name working inside coroutines
+  name = sessen.get_name()
+  with _loops_lock:
+    loop = _loops.get(name)
+    if loop is None:
+      loop = asyncio.new_event_loop()
+      threading.Thread(target=loop.run_forever, daemon=True).start()
+      _loops[name] = loop
+  return loop
+
+def run(coro, timeout=None):
+  # Runs a coroutine on the extension's loop from a regular thread and returns its result
+  return asyncio.run_coroutine_threadsafe(coro, get_loop()).result(timeout)
+
+async def call(func, *args, **kwargs):
+  if sessen.is_sandboxed:
+    return await api_client._invoke_async(func, args, kwargs)
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(None, functools.partial(getattr(sessen.api, func), *args, **kwargs))
+
+async def _invoke_many(calls):
+  if sessen.is_sandboxed:
+    return await api_client._invoke_many_async(calls)
+  return await asyncio.get_running_loop().run_in_executor(None, sessen._invoke_many, calls)
+
+def _start_handler(callback, d):
+  asyncio.run_coroutine_threadsafe(_handle(callback, d), get_loop())
+
+async def _handle(callback, d):
+  connection = Connection(d)
+  try:
+    await callback(connection)
+  except Exception:
+    sys.excepthook(*sys.exc_info())
+  finally:
+    await connection.close()
+
+class Connection(sessen.Connection):
+  # Passed to async def handlers, I/O methods are coroutines
+  def __del__(self):
+    # The handler wrapper closes the connection, there's no loop to await on here
+    pass
+
+  async def close(self):
+    if not self.closed:
+      self.closed = True
+      try:
+        if self._write_buffer:
+          await self.flush()
+      finally:
+        await call('connection_close', self.handle, self.route_regex)
+
+  async def read(self, length):
+    return await call('connection_read', self.handle, length)
+
+  async def receive_json(self):
+    cl = int(self.request_headers['Content-Length'][0])
+    chunks = []
+    remaining = cl
+    while remaining > 0:
+      b = await self.read(min(1024**2, remaining))
+      if not b:
+        break
+      chunks.append(b)
+      remaining -= len(b)
+    return json.loads(b''.join(chunks).decode())
+
+  async def _ensure_response_started(self):
+    if not self.response_started:
+      self.response_started = True
+      await call('connection_begin_response', self.handle, self.response_code, self.headers)
+
+  async def write(self, data, encoding='utf-8'):
+    if type(data) is str:
+      data = data.encode(encoding)
+    self._write_buffer.append(data)
+    self._write_buffered += len(data)
+    if self._write_buffered >= self.write_buffer_size:
+      await self.flush()
+
+  async def flush(self):
+    await self._ensure_response_started()
+    if self._write_buffer:
+      data = b''.join(self._write_buffer)
+      self._write_buffer = []
+      self._write_buffered = 0
+      await call('connection_write', self.handle, data)
+
+  async def send_text(self, text, content_type='text/plain', encoding='utf-8'):
+    if type(text) is str:
+      text = text.encode(encoding)
+    self.set_response_code(200)
+    self.add_header('Content-Type', content_type)
+    self.add_header('Content-Length', len(text))
+    await self.write(text)
+
+  async def send_stream(self, chunks, content_type='text/plain', encoding='utf-8'):
+    # Chunks may come from a regular or an async iterable
+    self.add_header('Content-Type', content_type)
+    if hasattr(chunks, '__aiter__'):
+      async for chunk in chunks:
+        await self.write(chunk, encoding)
+    else:
+      for chunk in chunks:
+        await self.write(chunk, encoding)
+    await self.flush()
+
+  async def send_html(self, html):
+    await self.send_text(html, content_type='text/html')
+
+  async def send_json(self, data):
+    j = json.dumps(data)
+    await self.send_text(j, content_type='application/json')
+
+class _Datastore(object):
+  sep = sessen.datastore.sep
+
+  def join_path(self, *paths):
+    return sessen.datastore.join_path(*paths)
+
+  def extension_path(self, path=None):
+    return sessen.datastore.extension_path(path)
+
+  def shared_path(self, path):
+    return sessen.datastore.shared_path(path)
+
+  async def get_raw(self, path):
+    return await call('datastore_get', sessen._get_secret(), path)
+
+  async def set_raw(self, path, value):
+    try:
+      await call('datastore_set', sessen._get_secret(), path, value)
+    finally:
+      sessen.datastore._invalidate(path)
+
+  async def get(self, path, default=None):
+    # Shares sessen.datastore's cache when it's enabled
+    cache = sessen.datastore._cache
+    if cache:
+      hit, value = cache.get(path)
+      if hit:
+        return default if value is sessen._MISSING else value
+      generation = cache.generation
+    try:
+      value = pickle.loads(await self.get_raw(path))
+    except KeyError:
+      value = sessen._MISSING
+    if cache:
+      cache.put(path, value, generation)
+    return default if value is sessen._MISSING else value
+
+  async def set(self, path, value):
+    await self.set_raw(path, pickle.dumps(value))
+
+  async def delete(self, path):
+    try:
+      await call('datastore_delete', sessen._get_secret(), path)
+    finally:
+      sessen.datastore._invalidate(path)
+
+  async def keys(self, path, page_size=None):
+    cursor = None
+    while True:
+      page = await call('datastore_keys_page', sessen._get_secret(), path, cursor, page_size)
+      for i in page['keys']:
+        yield i
+      cursor = page['cursor']
+      if cursor is None:
+        return
+
+  async def test_and_set(self, path, value):
+    try:
+      return pickle.loads(await call('datastore_test_and_set', sessen._get_secret(), path, pickle.dumps(value)))
+    finally:
+      sessen.datastore._invalidate(path)
+
+  async def get_many(self, paths, default=None):
+    values = await call('datastore_get_many', sessen._get_secret(), list(paths))
+    return [default if r is None else pickle.loads(r) for r in values]
+
+  async def set_many(self, items):
+    if hasattr(items, 'items'):
+      items = items.items()
+    items = [[path, pickle.dumps(value)] for path, value in items]
+    try:
+      await call('datastore_set_many', sessen._get_secret(), items)
+    finally:
+      for path, value in items:
+        sessen.datastore._invalidate(path)
+
+  async def delete_many(self, paths):
+    paths = list(paths)
+    secret = sessen._get_secret()
+    try:
+      results = await _invoke_many([('datastore_delete', (secret, path), {}) for path in paths])
+    finally:
+      for path in paths:
+        sessen.datastore._invalidate(path)
+    for r, ex in results:
+      if ex and not isinstance(ex, KeyError):
+        raise ex
+
+  async def delete_prefix(self, path):
+    try:
+      return await call('datastore_delete_prefix', sessen._get_secret(), path)
+    finally:
+      sessen.datastore._invalidate(path, True)
+
+  async def watch(self, path, since_version=None, timeout=None):
+    # Same as sessen.datastore.watch
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+      remaining = None if deadline is None else max(0, deadline - loop.time())
+      result = await call('datastore_watch', sessen._get_secret(), path, since_version, remaining)
+      if since_version is None or result['keys'] != [] or (deadline is not None and loop.time() >= deadline):
+        return result
+      since_version = result['version']
+
+datastore = _Datastore()
+
+class File(object):
+  def __init__(self, handle, mode, encoding):
+    self.handle = handle
+    self.mode = mode
+    if encoding is not None:
+      self.encoding = encoding
+    self.closed = False
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_val, exc_tb):
+    await self.close()
+
+  async def close(self):
+    if not self.closed:
+      self.closed = True
+      await call('file_close', self.handle)
+
+  def fileno(self):
+    return self.handle
+
+  async def read(self, length=None):
+    if length is None:
+      chunks = []
+      while True:
+        r = await self.read(64*1024)
+        if not r:
+          return (b'' if 'b' in self.mode else '').join(chunks)
+        chunks.append(r)
+
+    data = await call('file_read', self.handle, length)
+    if hasattr(self, 'encoding'):
+      data = data.decode(self.encoding)
+    return data
+
+  async def write(self, data):
+    if hasattr(self, 'encoding'):
+      data = data.encode(self.encoding)
+    await call('file_write', self.handle, data)
+
+  async def flush(self):
+    await call('file_flush', self.handle)
+
+  async def seek(self, offset, whence=0):
+    await call('file_seek', self.handle, offset, whence)
+
+  async def tell(self):
+    return await call('file_tell', self.handle)
+
+  async def stat(self):
+    return sessen._make_stat(await call('file_fstat', self.handle))
+
+async def open(path, mode, encoding=None):
+  if encoding is None and 'b' not in mode:
+    encoding = sys.getdefaultencoding()
+  handle = await call('file_open', sessen._get_secret(), path, mode, encoding)
+  return File(handle, mode, encoding)
+
+async def get_file(path):
+  async with await open(path, 'rb') as f:
+    return await f.read()
+
+async def write_file(path, data, mode='wb'):
+  async with await open(path, mode) as f:
+    await f.write(data)
+
+async def webrequest(method, url, headers=None, data=None, ssl_verify=True, timeout=None):
+  if headers is None:
+    headers = {'User-Agent': sessen.USER_AGENT}
+  req = sessen.webrequest.__new__(sessen.webrequest)
+  req._load(await call('webrequest', sessen._get_secret(), method, url, headers, data, ssl_verify, timeout))
+  return req
+
+async def _send_message_and_get_reply(recipient, message, timeout=None):
+  sessen._ensure_postmaster_running()
+  id = sessen.secure_token()
+  # The postmaster puts the reply on this the same way it would a queue
+  result = api_client._FutureResult(asyncio.get_running_loop())
+  sessen._shared_function_results[id] = result
+  message['sender'] = sessen.get_name()
+  message['id'] = id
+  try:
+    await call('messages_send', sessen._get_secret(), recipient, message)
+    return await asyncio.wait_for(result.future, timeout)
+  except asyncio.TimeoutError:
+    raise sessen.ExtensionProxyTimeout()
+  finally:
+    sessen._shared_function_results.pop(id)
+
+class ExtensionProxy(object):
+  def __init__(self, name, timeout=None):
+    self._name = name
+    self._timeout = timeout
+
+  async def _has_function(self, func):
+    return await _send_message_and_get_reply(self._name, {'action':'has_function', 'name': func}, timeout=self._timeout)
+
+  async def _list_functions(self):
+    return await _send_message_and_get_reply(self._name, {'action':'list_functions'}, timeout=self._timeout)
+
+  def __getattr__(self, func):
+    return lambda *a, **k: _send_message_and_get_reply(self._name,
+              {'action':'call', 'func':func, 'args':a, 'kwargs':k}, timeout=self._timeout)
+
+async def get_neighbors(timeout=None):
+  return [ExtensionProxy(name, timeout=timeout) for name in await call('messages_list_recipients', sessen._get_secret())]
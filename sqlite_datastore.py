@@ -1,15 +1,62 @@
-import builtins
+import time, threading
 import multithreaded_sqlite, config
 
 PAGE_SIZE = 100
+MAX_PAGE_SIZE = 10000
+MAX_VARIABLES = 500
+PRUNE_INTERVAL = 1000
 
 db_path = config.get('datastore_path', default='datastore.db')
 db_timeout = config.get_int('datastore_timeout', default=5*60)
-db_connection = multithreaded_sqlite.connect(db_path, db_timeout)
+db_reader_count = config.get_int('datastore_reader_count', default=4)
+db_synchronous = config.get('datastore_synchronous', default='NORMAL')
+db_journal_mode = config.get('datastore_journal_mode', default='WAL')
+db_group_commit_delay = config.get_float('datastore_group_commit_delay', default=0)
+db_connection = multithreaded_sqlite.connect(db_path, db_timeout, db_reader_count, db_synchronous,
+                                             db_journal_mode, db_group_commit_delay)
+change_history = config.get_int('datastore_change_history', default=10000)
 
 def _init(connection):
   cur = connection.execute('create table if not exists datastore (key BLOB PRIMARY KEY, value BLOB)')
-db_connection.run(_init)
+  cur.execute('create table if not exists changes (version INTEGER PRIMARY KEY AUTOINCREMENT, key BLOB, is_prefix INTEGER)')
+  version = cur.execute('SELECT max(version) FROM changes').fetchone()[0]
+  cur.close()
+  return version or 0
+
+# Every write is recorded in the changes table with an increasing version so
+# watchers can find out what changed since the last version they saw. Only the
+# most recent change_history versions are kept.
+_version = db_connection.run(_init)
+_version_changed = threading.Condition()
+
+def _record_changes(connection, paths, is_prefix=False):
+  cur = connection.executemany('INSERT INTO changes (key, is_prefix) VALUES (?,?)', [(path, is_prefix) for path in paths])
+  version = cur.execute('SELECT last_insert_rowid()').fetchone()[0]
+  if version // PRUNE_INTERVAL != (version - len(paths)) // PRUNE_INTERVAL:
+    cur.execute('DELETE FROM changes WHERE version <= (?)', (version - change_history,))
+  cur.close()
+  return version
+
+def _notify(version):
+  # Called once the change with this version has been committed
+  global _version
+  with _version_changed:
+    if version > _version:
+      _version = version
+      _version_changed.notify_all()
+
+def _snapshot(function):
+  # Runs a read made of several statements in one transaction so they all
+  # see the same commit
+  def f(connection):
+    if connection.in_transaction:
+      return function(connection)
+    connection.execute('BEGIN')
+    try:
+      return function(connection)
+    finally:
+      connection.commit()
+  return f
 
 
 def get(path):
@@ -20,56 +67,174 @@ def get(path):
     if r is None:
       raise KeyError(path)
     return r[0]
-  return db_connection.run(f)
+  return db_connection.run_read(f)
 
   
 def set(path, value):
   def f(connection):
-    with connection:
-      cur = connection.execute('INSERT OR REPLACE INTO datastore VALUES (?,?)', (path, value))
-      cur.close()
-  return db_connection.run(f)
+    cur = connection.execute('INSERT OR REPLACE INTO datastore VALUES (?,?)', (path, value))
+    cur.close()
+    return _record_changes(connection, [path])
+  _notify(db_connection.run_batched(f))
 
 
 def delete(path):
   def f(connection):
-    with connection:
-      cur = connection.execute('DELETE FROM datastore WHERE key=(?)', (path,))
+    cur = connection.execute('DELETE FROM datastore WHERE key=(?)', (path,))
+    cur.close()
+    if cur.rowcount == 0:
+      raise KeyError(path)
+    return _record_changes(connection, [path])
+  _notify(db_connection.run_batched(f))
+
+
+def get_many(paths):
+  # Returns the values in the same order as the paths, None for missing ones
+  def f(connection):
+    values = {}
+    unique = list(dict.fromkeys(paths))
+    for i in range(0, len(unique), MAX_VARIABLES):
+      chunk = unique[i:i+MAX_VARIABLES]
+      cur = connection.execute('SELECT key, value FROM datastore WHERE key IN (%s)' % ','.join('?'*len(chunk)), chunk)
+      values.update(cur.fetchall())
       cur.close()
-      if cur.rowcount == 0:
-        raise KeyError(path)
-  return db_connection.run(f)
+    return [values.get(path) for path in paths]
+  return db_connection.run_read(_snapshot(f))
 
 
-def keys(path, page):
+def set_many(items):
+  items = list(items)
+  def f(connection):
+    cur = connection.executemany('INSERT OR REPLACE INTO datastore VALUES (?,?)', items)
+    cur.close()
+    return _record_changes(connection, list(dict.fromkeys(path for path, value in items)))
+  if items:
+    _notify(db_connection.run_batched(f))
+
+
+def delete_prefix(path):
+  # Deletes every key starting with path and returns how many there were
+  sql = 'DELETE FROM datastore WHERE key >= (?)'
+  params = [path]
+  upper = _successor(path)
+  if upper is not None:
+    sql += ' AND key < (?)'
+    params.append(upper)
   def f(connection):
-    results = builtins.set()
-    limit = PAGE_SIZE
-    offset = page*limit
-    cur = connection.execute('SELECT key from datastore WHERE key LIKE (?) LIMIT (?), (?)', (path+'%',offset,limit))
+    cur = connection.execute(sql, params)
+    cur.close()
+    if cur.rowcount == 0:
+      return 0, None
+    return cur.rowcount, _record_changes(connection, [path], True)
+  count, version = db_connection.run_batched(f)
+  if version:
+    _notify(version)
+  return count
+
+
+def _successor(prefix):
+  # The smallest string greater than every string starting with prefix, or
+  # None if there isn't one. Keys compare as UTF-8 bytes, which orders them by
+  # code point, so incrementing the last code point that can be incremented
+  # gives the upper bound of a prefix range.
+  prefix = prefix.rstrip('\U0010ffff')
+  if not prefix:
+    return None
+  c = ord(prefix[-1]) + 1
+  if 0xd800 <= c <= 0xdfff:
+    # Surrogates can't be encoded so skip to the next valid code point
+    c = 0xe000
+  return prefix[:-1] + chr(c)
+
+
+def _range_query(path, after, limit, offset=0):
+  sql = 'SELECT key FROM datastore WHERE key >= (?)'
+  params = [path]
+  upper = _successor(path)
+  if upper is not None:
+    sql += ' AND key < (?)'
+    params.append(upper)
+  if after is not None:
+    sql += ' AND key > (?)'
+    params.append(after)
+  sql += ' ORDER BY key LIMIT (?) OFFSET (?)'
+  params.extend((limit, offset))
+  def f(connection):
+    cur = connection.execute(sql, params)
     r = [i[0] for i in cur.fetchall()]
     cur.close()
     return r
-  return db_connection.run(f)
+  return db_connection.run_read(f)
+
+
+def keys(path, page):
+  return _range_query(path, None, PAGE_SIZE, page*PAGE_SIZE)
+
+
+def keys_after(path, after, limit=PAGE_SIZE):
+  # Keys starting with path that sort after the key after, or from the start if it's None
+  return _range_query(path, after, limit)
 
 
 def test_and_set(path, value):
+  # Batched writes run one at a time in the writer's transaction, so the read
+  # and the write can't interleave with another call
   def f(connection):
-    old_level = connection.isolation_level
-    connection.isolation_level = 'EXCLUSIVE'
-    try:
-      cur = connection.execute('BEGIN EXCLUSIVE')
-      cur.execute('SELECT value FROM datastore WHERE key=(?)', (path,))
-      r = cur.fetchone()
-      cur.execute('INSERT OR REPLACE INTO datastore VALUES (?,?)', (path, value))
-      connection.commit()
-    except Exception as ex:
-      connection.rollback()
-      raise ex
-    finally:
-      connection.isolation_level = old_level
+    cur = connection.execute('SELECT value FROM datastore WHERE key=(?)', (path,))
+    r = cur.fetchone()
+    cur.execute('INSERT OR REPLACE INTO datastore VALUES (?,?)', (path, value))
+    cur.close()
+    return r, _record_changes(connection, [path])
+  # The KeyError is raised out here since raising in the batch would roll the write back
+  r, version = db_connection.run_batched(f)
+  _notify(version)
+  if r is None:
+    raise KeyError(path)
+  return r[0]
+
+
+def _changes_since(path, since_version):
+  # Returns the last version read and the keys starting with path changed
+  # after since_version. Keys is None if the changes were pruned. A deleted
+  # prefix is reported as whichever of it and path is longer.
+  def f(connection):
+    cur = connection.execute('SELECT min(version), max(version) FROM changes')
+    oldest, latest = cur.fetchone()
+    latest = latest or 0
+    oldest = oldest or latest + 1
+    if since_version is None:
       cur.close()
-    if r is None:
-      raise KeyError(path)
-    return r[0]
-  return db_connection.run(f)
+      return latest, []
+    if since_version > latest or since_version < oldest - 1:
+      cur.close()
+      return latest, None
+    keys = []
+    version = since_version
+    for version, key, is_prefix in cur.execute('SELECT version, key, is_prefix FROM changes WHERE version > (?) ORDER BY version', (since_version,)):
+      if key.startswith(path):
+        keys.append(key)
+      elif is_prefix and path.startswith(key):
+        keys.append(path)
+    cur.close()
+    return version, list(dict.fromkeys(keys))
+  return db_connection.run_read(_snapshot(f))
+
+
+def watch(path, since_version=None, timeout=None):
+  # Waits until a key starting with path changes after since_version and
+  # returns the version and keys like _changes_since. With no since_version
+  # it returns the current version right away.
+  deadline = None if timeout is None else time.monotonic() + timeout
+  while True:
+    with _version_changed:
+      observed = _version
+    version, keys = _changes_since(path, since_version)
+    if since_version is None or keys is None or keys:
+      return version, keys
+    since_version = version
+    with _version_changed:
+      while _version == observed:
+        remaining = None if deadline is None else deadline - time.monotonic()
+        if remaining is not None and remaining <= 0:
+          return version, []
+        _version_changed.wait(remaining)
@@ -0,0 +1,139 @@
+import os, mimetypes, email.utils, urllib.parse
+import compression
+
+CHUNK_SIZE = 1024**2
+
+def resolve(folder, relative_path):
+  relative_path = urllib.parse.unquote(urllib.parse.urlsplit(relative_path).path)
+  folder = os.path.realpath(folder)
+  path = os.path.realpath(os.path.join(folder, relative_path.lstrip('/')))
+  if path != folder and not path.startswith(folder.rstrip(os.path.sep) + os.path.sep):
+    return None
+  if os.path.isdir(path):
+    path = os.path.join(path, 'index.html')
+  return path
+
+def make_etag(stat):
+  return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+def is_not_modified(request, etag, mtime):
+  if_none_match = request.headers.get('If-None-Match')
+  if if_none_match is not None:
+    tags = [i.strip() for i in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+  if_modified_since = request.headers.get('If-Modified-Since')
+  if if_modified_since:
+    try:
+      return int(mtime) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+      pass
+  return False
+
+def parse_range(request, etag, size):
+  header = request.headers.get('Range')
+  if not header or not header.startswith('bytes='):
+    return None
+  if_range = request.headers.get('If-Range')
+  if if_range and if_range.strip() != etag:
+    return None
+  spec = header[6:].strip()
+  if ',' in spec:
+    # Multipart ranges aren't supported, fall back to the full file
+    return None
+  start, _, end = spec.partition('-')
+  try:
+    if not start:
+      length = int(end)
+      if length < 1:
+        return False
+      return max(0, size-length), size-1
+    start = int(start)
+    end = int(end) if end else size-1
+  except ValueError:
+    return None
+  if start >= size or end < start:
+    return False
+  return start, min(end, size-1)
+
+def send_file(request, f, offset, count):
+  request.wfile.flush()
+  connection = getattr(request, 'connection', None)
+  if connection is not None:
+    # socket.sendfile uses os.sendfile when the socket allows it
+    connection.sendfile(f, offset, count)
+    return
+  f.seek(offset)
+  while count > 0:
+    buf = f.read(min(CHUNK_SIZE, count))
+    if not buf:
+      break
+    request.wfile.write(buf)
+    count -= len(buf)
+
+def serve(request, folder, relative_path):
+  if request.command not in ('GET', 'HEAD'):
+    request.send_response(405)
+    request.send_header('Allow', 'GET, HEAD')
+    request.send_header('Content-Length', '0')
+    request.end_headers()
+    return 405
+  path = resolve(folder, relative_path)
+  try:
+    if path is None:
+      raise FileNotFoundError(relative_path)
+    f = open(path, 'rb')
+  except (FileNotFoundError, IsADirectoryError, NotADirectoryError, PermissionError):
+    request.send_error(404)
+    return 404
+  try:
+    stat = os.fstat(f.fileno())
+    etag = make_etag(stat)
+    mtime = stat.st_mtime
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    headers = [
+               ('Last-Modified', email.utils.formatdate(mtime, usegmt=True)),
+               ('Accept-Ranges', 'bytes'),
+              ]
+    if compression.is_compressible(content_type):
+      headers.append(('Vary', 'Accept-Encoding'))
+      encoding = None
+      if not request.headers.get('Range') and stat.st_size >= compression.get_min_size():
+        encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+      compressed_path = compression.get_precompressed(path, stat, encoding) if encoding else None
+      if compressed_path:
+        f.close()
+        f = open(compressed_path, 'rb')
+        etag = etag[:-1] + '-' + encoding + '"'
+        headers.append(('Content-Encoding', encoding))
+        stat = os.fstat(f.fileno())
+    headers.append(('ETag', etag))
+    if is_not_modified(request, etag, mtime):
+      request.send_response(304)
+      for name, value in headers:
+        request.send_header(name, value)
+      request.end_headers()
+      return 304
+    byte_range = parse_range(request, etag, stat.st_size)
+    if byte_range is False:
+      request.send_response(416)
+      request.send_header('Content-Range', 'bytes */%d' % stat.st_size)
+      request.send_header('Content-Length', '0')
+      request.end_headers()
+      return 416
+    offset, count = 0, stat.st_size
+    status = 200
+    if byte_range:
+      offset, count = byte_range[0], byte_range[1]-byte_range[0]+1
+      status = 206
+      headers.append(('Content-Range', 'bytes %d-%d/%d' % (byte_range[0], byte_range[1], stat.st_size)))
+    request.send_response(status)
+    headers.append(('Content-Type', content_type))
+    headers.append(('Content-Length', str(count)))
+    for name, value in headers:
+      request.send_header(name, value)
+    request.end_headers()
+    if request.command != 'HEAD':
+      send_file(request, f, offset, count)
+    return status
+  finally:
+    f.close()